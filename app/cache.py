@@ -0,0 +1,237 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from fastapi import HTTPException
+
+from app import data_version, database, precompute, singleflight
+
+MAX_ENTRIES = int(os.getenv("SPN_CACHE_MAX_ENTRIES", "2048"))
+STALE_TIMEOUT = float(os.getenv("SPN_CACHE_STALE_TIMEOUT_SECONDS", "2"))
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_refreshing = {}
+_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "evictions": 0, "errors": 0}
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kpi-cache")
+
+
+def normalize(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items() if v is not None))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(normalize(v) for v in value))
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def make_key(endpoint, kwargs):
+    return (endpoint, normalize({k: v for k, v in kwargs.items() if k != "db"}))
+
+
+def _get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+        return entry
+
+
+def _put(key, version, value):
+    with _lock:
+        _entries[key] = {"version": version, "value": value, "stored_at": time.time()}
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats["evictions"] += 1
+
+
+def _count(stat):
+    with _lock:
+        _stats[stat] += 1
+
+
+def _is_failure(exc):
+    if isinstance(exc, HTTPException):
+        return exc.status_code >= 500
+    return True
+
+
+def _compute_miss(func, key, version, kwargs):
+    _count("misses")
+    value = func(**kwargs)
+    _put(key, version, value)
+    return value
+
+
+async def _compute_miss_async(func, key, version, kwargs):
+    _count("misses")
+    value = await func(**kwargs)
+    _put(key, version, value)
+    return value
+
+
+def _compute_with_own_session(func, key, version, kwargs):
+    db = database.SessionLocal()
+    try:
+        value = func(**dict(kwargs, db=db))
+        _put(key, version, value)
+        return value
+    finally:
+        db.close()
+        with _lock:
+            _refreshing.pop(key, None)
+
+
+def _refresh(func, key, version, kwargs):
+    with _lock:
+        future = _refreshing.get(key)
+        if future is None:
+            _stats["refreshes"] += 1
+            future = _executor.submit(_compute_with_own_session, func, key, version, kwargs)
+            _refreshing[key] = future
+    return future
+
+
+async def _compute_async(func, key, version, kwargs):
+    try:
+        value = await func(**kwargs)
+        _put(key, version, value)
+        return value
+    finally:
+        with _lock:
+            _refreshing.pop(key, None)
+
+
+def _refresh_async(func, key, version, kwargs):
+    with _lock:
+        task = _refreshing.get(key)
+        if task is None:
+            _stats["refreshes"] += 1
+            task = asyncio.ensure_future(_compute_async(func, key, version, kwargs))
+            _refreshing[key] = task
+    return task
+
+
+def _async_kpi_cache(func):
+    @functools.wraps(func)
+    async def wrapper(**kwargs):
+        key = make_key(func.__name__, kwargs)
+        precompute.record(key, func, kwargs)
+        entry = _get(key)
+        try:
+            version = await asyncio.to_thread(data_version.current)
+        except Exception:
+            if entry is None:
+                raise
+            _count("stale_hits")
+            return entry["value"]
+
+        if entry is not None and entry["version"] == version:
+            _count("hits")
+            return entry["value"]
+
+        if entry is None:
+            return await singleflight.group.do_async(key, lambda: _compute_miss_async(func, key, version, kwargs))
+
+        task = _refresh_async(func, key, version, kwargs)
+        try:
+            value = await asyncio.wait_for(asyncio.shield(task), STALE_TIMEOUT)
+        except asyncio.TimeoutError:
+            _count("stale_hits")
+            return entry["value"]
+        except Exception as e:
+            if not _is_failure(e):
+                raise
+            _count("errors")
+            _count("stale_hits")
+            return entry["value"]
+        _count("misses")
+        return value
+
+    wrapper.kpi_cached = True
+    return wrapper
+
+
+def kpi_cache(func):
+    if asyncio.iscoroutinefunction(func):
+        return _async_kpi_cache(func)
+
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        key = make_key(func.__name__, kwargs)
+        precompute.record(key, func, {k: v for k, v in kwargs.items() if k != "db"})
+        entry = _get(key)
+        try:
+            version = data_version.current()
+        except Exception:
+            if entry is None:
+                raise
+            _count("stale_hits")
+            return entry["value"]
+
+        if entry is not None and entry["version"] == version:
+            _count("hits")
+            return entry["value"]
+
+        if entry is None:
+            # Identical requests arriving while the first one is still
+            # running wait for its result instead of scanning again.
+            return singleflight.group.do(key, lambda: _compute_miss(func, key, version, kwargs))
+
+        # Stale while revalidate: the entry belongs to an older data version,
+        # the refresh runs on its own session and the old value is served if
+        # the database fails or does not answer within STALE_TIMEOUT.
+        future = _refresh(func, key, version, {k: v for k, v in kwargs.items() if k != "db"})
+        try:
+            value = future.result(timeout=STALE_TIMEOUT)
+        except TimeoutError:
+            _count("stale_hits")
+            return entry["value"]
+        except Exception as e:
+            if not _is_failure(e):
+                raise
+            _count("errors")
+            _count("stale_hits")
+            return entry["value"]
+        _count("misses")
+        return value
+
+    wrapper.kpi_cached = True
+    return wrapper
+
+
+def refresh(func, kwargs, version):
+    # Recomputes an entry for a new data version ahead of the requests, on
+    # its own session. Returns None when the entry is already current,
+    # otherwise an awaitable that requests for the same key share.
+    key = make_key(func.__name__, kwargs)
+    entry = _get(key)
+    if entry is not None and entry["version"] == version:
+        return None
+    if asyncio.iscoroutinefunction(func):
+        return _refresh_async(func, key, version, kwargs)
+    return asyncio.wrap_future(_refresh(func, key, version, kwargs))
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def stats():
+    with _lock:
+        served = _stats["hits"] + _stats["stale_hits"] + _stats["misses"]
+        return dict(
+            _stats,
+            entries=len(_entries),
+            max_entries=MAX_ENTRIES,
+            hit_rate=round((_stats["hits"] + _stats["stale_hits"]) / served, 4) if served else 0.0,
+            data_version=data_version.info(),
+            singleflight=singleflight.group.stats(),
+        )
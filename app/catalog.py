@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+from app import data_version, database
+
+logger = logging.getLogger(__name__)
+
+# dimension -> (query, key column, attributes). The dimensions are small, they
+# are held in memory with their text values trimmed once at load.
+DIMENSIONS = {
+    "dimcars": ("SELECT car_pk, brand, slug, sub_type, plate_number, image FROM dimcars ORDER BY car_pk",
+                "car_pk", ("brand", "slug", "sub_type", "plate_number", "image")),
+    "dimregions": ("SELECT region_pk, pays FROM dimregions ORDER BY region_pk", "region_pk", ("pays",)),
+    # Several destinations per region: the key is the region, not the row.
+    "dimdestinations": ("SELECT region_fk, dest_code FROM dimdestinations ORDER BY dest_code",
+                        "region_fk", ("dest_code",)),
+    "dimoffers": ("SELECT offer_pk, offer_code, adjustement_type FROM dimoffers ORDER BY offer_pk",
+                  "offer_pk", ("offer_code", "adjustement_type")),
+    "dimrequesttypes": ("SELECT req_type_pk, req_type FROM dimrequesttypes ORDER BY req_type_pk",
+                        "req_type_pk", ("req_type",)),
+    "dimbenchmarks": ("SELECT benchmark_pk, source FROM dimbenchmarks ORDER BY benchmark_pk",
+                      "benchmark_pk", ("source",)),
+}
+
+_lock = threading.Lock()
+_state = {"version": None, "rows": None, "keys": None, "labels": None,
+          "loaded_at": None, "load_seconds": None, "forced_for": None, "last_error": None}
+
+
+def _clean(value):
+    return value.strip() if isinstance(value, str) else value
+
+
+def _index(tables):
+    keys = {}
+    labels = {}
+    for dimension, (_, key, attributes) in DIMENSIONS.items():
+        for attribute in attributes:
+            by_value = keys[(dimension, attribute)] = {}
+            by_key = labels[(dimension, attribute)] = {}
+            for row in tables[dimension]:
+                by_value.setdefault(row[attribute], set()).add(row[key])
+                by_key.setdefault(row[key], row[attribute])
+    return keys, labels
+
+
+def load(version=None):
+    started = time.perf_counter()
+    db = database.SessionLocal()
+    try:
+        tables = {}
+        for dimension, (query, key, attributes) in DIMENSIONS.items():
+            tables[dimension] = [
+                {name: _clean(value) for name, value in zip((key,) + attributes, row)}
+                for row in db.execute(text(query))
+            ]
+    finally:
+        db.close()
+    keys, labels = _index(tables)
+    _state.update(
+        version=version, rows=tables, keys=keys, labels=labels,
+        loaded_at=time.time(), load_seconds=round(time.perf_counter() - started, 3), last_error=None,
+    )
+    logger.info("dimension catalog loaded for version %s in %.3fs", version, _state["load_seconds"])
+
+
+def ensure_current(force=False):
+    # Reloaded when the data version moves. Callers wait for the reload, a
+    # result cached for the new version must not use the old keys. A failed
+    # reload keeps the previous catalog.
+    try:
+        version = data_version.current()
+    except Exception:
+        if _state["rows"] is None:
+            raise
+        return
+    if not force and _state["rows"] is not None and _state["version"] == version:
+        return
+    with _lock:
+        if not force and _state["rows"] is not None and _state["version"] == version:
+            return
+        try:
+            load(version)
+        except Exception as e:
+            _state["last_error"] = str(e)
+            if _state["rows"] is None:
+                raise
+            logger.warning("dimension catalog reload failed, keeping version %s: %s", _state["version"], e)
+
+
+def keys(dimension, attribute, values):
+    # Keys whose attribute matches one of the values, None when the catalog
+    # cannot be loaded so the caller can fall back to a subquery.
+    try:
+        ensure_current()
+    except Exception as e:
+        logger.warning("dimension catalog unavailable: %s", e)
+        return None
+    index = _state["keys"][(dimension, attribute)]
+    found = set()
+    for value in values:
+        found |= index.get(_clean(value), set())
+    return sorted(found)
+
+
+def labels(dimension, attribute, wanted=()):
+    ensure_current()
+    mapping = _state["labels"][(dimension, attribute)]
+    if any(key is not None and key not in mapping for key in wanted) and _state["forced_for"] != _state["version"]:
+        # A key the catalog has not seen yet: the dimension was loaded after
+        # the catalog, reload once for this version.
+        _state["forced_for"] = _state["version"]
+        ensure_current(force=True)
+        mapping = _state["labels"][(dimension, attribute)]
+    return mapping
+
+
+def values(dimension, attribute):
+    ensure_current()
+    return sorted(value for value in _state["keys"][(dimension, attribute)] if value)
+
+
+def rows(dimension):
+    ensure_current()
+    return _state["rows"][dimension]
+
+
+def attach_labels(results, dimensions, measures):
+    # results are aggregates per foreign key; dimensions maps a key field to
+    # (dimension, attribute, output name). Rows that end up with the same
+    # labels are summed, rows whose key is unknown are dropped like with an
+    # inner join.
+    results = list(results)
+    label_maps = {
+        field: labels(dimension, attribute, [getattr(row, field) for row in results])
+        for field, (dimension, attribute, _) in dimensions.items()
+    }
+    merged = {}
+    for row in results:
+        label = tuple(label_maps[field].get(getattr(row, field)) for field in dimensions)
+        if None in label:
+            continue
+        totals = merged.setdefault(label, dict.fromkeys(measures, 0))
+        for measure in measures:
+            totals[measure] += getattr(row, measure) or 0
+    return [
+        dict(zip((name for _, _, name in dimensions.values()), label), **totals)
+        for label, totals in merged.items()
+    ]
+
+
+def info():
+    return {
+        "version": _state["version"],
+        "loaded_at": _state["loaded_at"],
+        "load_seconds": _state["load_seconds"],
+        "rows": {dimension: len(rows) for dimension, rows in (_state["rows"] or {}).items()},
+        "last_error": _state["last_error"],
+    }
@@ -0,0 +1,92 @@
+import os
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MINIMUM_SIZE = int(os.getenv("SPN_COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("SPN_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("SPN_BROTLI_QUALITY", "4"))
+
+
+class CompressionMiddleware:
+    # Brotli when the client accepts it and the brotli package is installed,
+    # gzip otherwise. Bodies under minimum_size are sent as they are.
+    def __init__(self, app, minimum_size=MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=GZIP_LEVEL)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and brotli is not None:
+            accept_encoding = Headers(scope=scope).get("Accept-Encoding", "")
+            if "br" in accept_encoding:
+                await _BrotliResponder(self.app, self.minimum_size)(scope, receive, send)
+                return
+        await self.gzip(scope, receive, send)
+
+
+class _BrotliResponder:
+    def __init__(self, app, minimum_size):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.send = None
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            self.passthrough = "content-encoding" in Headers(raw=message["headers"])
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+        if self.passthrough:
+            if self.start_message is not None:
+                await self.send(self.start_message)
+                self.start_message = None
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start_message is not None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            if not more_body and len(body) < self.minimum_size:
+                await self.send(self.start_message)
+                self.start_message = None
+                await self.send(message)
+                self.passthrough = True
+                return
+            headers["Content-Encoding"] = "br"
+            headers.add_vary_header("Accept-Encoding")
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            if more_body:
+                # Streamed responses are compressed chunk by chunk.
+                del headers["Content-Length"]
+            else:
+                body = self.compressor.process(body) + self.compressor.finish()
+                headers["Content-Length"] = str(len(body))
+                await self.send(self.start_message)
+                self.start_message = None
+                await self.send({"type": "http.response.body", "body": body})
+                return
+            await self.send(self.start_message)
+            self.start_message = None
+
+        chunk = self.compressor.process(body)
+        if more_body:
+            chunk += self.compressor.flush()
+        else:
+            chunk += self.compressor.finish()
+        await self.send({"type": "http.response.body", "body": chunk, "more_body": more_body})
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import logging
+import os
+from datetime import date, datetime, time, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import parse_qsl
+
+from starlette.datastructures import Headers
+
+from app import data_version, serialization
+
+logger = logging.getLogger(__name__)
+
+# Within one probe interval a worker cannot see a new data version anyway.
+MAX_AGE = int(os.getenv("SPN_HTTP_MAX_AGE_SECONDS", str(int(data_version.PROBE_INTERVAL))))
+SKIP_PREFIXES = (
+    "/admin", "/metrics", "/ready", "/docs", "/redoc", "/openapi.json",
+    # Forecasts change when the models are retrained, not with the data.
+    "/predict_total_price", "/optimize_fleet", "/forecast",
+)
+
+
+def _normalized_query(query_string):
+    pairs = parse_qsl(query_string.decode("latin-1"), keep_blank_values=False)
+    return "&".join(f"{k}={v.strip()}" for k, v in sorted(pairs) if v.strip())
+
+
+def _representation(headers):
+    accept = headers.get("accept", "")
+    for media_type in (serialization.ARROW_MEDIA_TYPE, serialization.COLUMNAR_MEDIA_TYPE):
+        if media_type in accept:
+            return media_type
+    return ""
+
+
+def make_etag(version, scope, headers):
+    # The day is part of the tag for the endpoints whose periods end today.
+    parts = [str(version), date.today().isoformat(), scope["path"], _normalized_query(scope["query_string"]), _representation(headers)]
+    digest = hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:24]
+    return f'W/"{digest}"'
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
+
+def _not_modified_since(if_modified_since, last_modified):
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified.replace(microsecond=0) <= since
+
+
+def _last_modified():
+    # Only emitted when the load time is known. Like the ETag it moves at
+    # midnight, the periods that end today change with the day.
+    loaded_at = data_version.loaded_at()
+    if loaded_at is None:
+        return None
+    midnight = datetime.combine(date.today(), time.min).astimezone(timezone.utc)
+    return max(loaded_at.astimezone(timezone.utc), midnight)
+
+
+class ConditionalMiddleware:
+    # Tags GET responses with the data version and answers If-None-Match /
+    # If-Modified-Since with 304 before the request reaches an endpoint.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD") or scope["path"].startswith(SKIP_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        try:
+            version = await asyncio.to_thread(data_version.current)
+        except Exception as e:
+            logger.warning("data version unavailable, serving without ETag: %s", e)
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        etag = make_etag(version, scope, headers)
+        validators = [
+            (b"etag", etag.encode("latin-1")),
+            (b"cache-control", f"public, max-age={MAX_AGE}, must-revalidate".encode("latin-1")),
+        ]
+        last_modified = _last_modified()
+        if last_modified is not None:
+            validators.append((b"last-modified", format_datetime(last_modified, usegmt=True).encode("latin-1")))
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            not_modified = _etag_matches(if_none_match, etag)
+        else:
+            if_modified_since = headers.get("if-modified-since")
+            not_modified = bool(if_modified_since and last_modified and _not_modified_since(if_modified_since, last_modified))
+        if not_modified:
+            await send({"type": "http.response.start", "status": 304, "headers": validators})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_validators(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                present = Headers(raw=message["headers"])
+                message = dict(message, headers=list(message["headers"]))
+                message["headers"] += [(name, value) for name, value in validators if name.decode("latin-1") not in present]
+            await send(message)
+
+        await self.app(scope, receive, send_with_validators)
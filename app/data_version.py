@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from app import database
+
+PROBE_INTERVAL = float(os.getenv("SPN_VERSION_PROBE_SECONDS", "30"))
+
+_lock = threading.Lock()
+_state = {"version": None, "checked_at": 0.0, "changed_at": None, "loaded_at": None}
+
+
+def _probe(db):
+    # (version, load time), the load time is only known from etl_watermark.
+    if database.BACKEND == "duckdb":
+        from app import duckdb_backend
+
+        return duckdb_backend.data_version(), None
+
+    # The ETL can record its loads in an etl_watermark table, otherwise the
+    # highest fact key is used as the token of the loaded data.
+    watermark = None
+    if db.execute(text("SELECT to_regclass('etl_watermark')")).scalar():
+        watermark = db.execute(text("SELECT MAX(loaded_at) FROM etl_watermark")).scalar()
+    max_req_pk = db.execute(text("SELECT MAX(req_pk) FROM factrequests")).scalar()
+    if not watermark:
+        return str(max_req_pk), None
+    loaded_at = watermark if isinstance(watermark, datetime) else None
+    if loaded_at is not None and loaded_at.tzinfo is None:
+        loaded_at = loaded_at.replace(tzinfo=timezone.utc)
+    return f"{max_req_pk}:{watermark}", loaded_at
+
+
+def probe(db):
+    return _probe(db)[0]
+
+
+def current(force=False):
+    if not force and _state["version"] is not None and time.monotonic() - _state["checked_at"] < PROBE_INTERVAL:
+        return _state["version"]
+    # While another thread is probing, callers keep using the known version
+    # instead of queueing behind a possibly slow database.
+    if not _lock.acquire(blocking=_state["version"] is None or force):
+        return _state["version"]
+    try:
+        db = database.SessionLocal()
+        try:
+            version, loaded_at = _probe(db)
+        finally:
+            db.close()
+        if version != _state["version"]:
+            _state["version"] = version
+            _state["changed_at"] = datetime.now(timezone.utc)
+        _state["loaded_at"] = loaded_at
+        _state["checked_at"] = time.monotonic()
+        return version
+    finally:
+        _lock.release()
+
+
+def changed_at():
+    # When this worker first saw the current version, an upper bound for the
+    # time of the load that produced it.
+    return _state["changed_at"]
+
+
+def loaded_at():
+    # When the ETL recorded the load of the current version, None without
+    # etl_watermark. The same for every worker, unlike changed_at.
+    return _state["loaded_at"]
+
+
+def info():
+    return {
+        "version": _state["version"],
+        "changed_at": _state["changed_at"].isoformat() if _state["changed_at"] else None,
+        "loaded_at": _state["loaded_at"].isoformat() if _state["loaded_at"] else None,
+        "probe_interval_seconds": PROBE_INTERVAL,
+    }
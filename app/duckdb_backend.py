@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+from sqlalchemy import create_engine, event, text
+
+PARQUET_DIR = os.getenv("SPN_PARQUET_DIR", "parquet")
+BATCH_SIZE = 100000
+
+TABLES = [
+    "factrequests",
+    "dimdates",
+    "dimcars",
+    "dimclients",
+    "dimregions",
+    "dimdestinations",
+    "dimbenchmarks",
+    "dimoffers",
+    "dimrequesttypes",
+]
+
+# factrequests is split by pick-up year and month so date filtered queries
+# only open the matching files.
+PARTITIONS = {"factrequests": ["year", "month"]}
+
+
+def _manifest_path(directory):
+    return os.path.join(directory, "manifest.json")
+
+
+def _export_table(conn, table, directory):
+    import pyarrow.parquet as pq
+
+    from app import export
+
+    target = os.path.join(directory, table)
+    partition_cols = PARTITIONS.get(table)
+    if partition_cols:
+        query = (
+            f"SELECT *, EXTRACT(YEAR FROM pick_up_date)::int AS year, "
+            f"EXTRACT(MONTH FROM pick_up_date)::int AS month FROM {table}"
+        )
+    else:
+        query = f"SELECT * FROM {table}"
+
+    result = conn.execution_options(stream_results=True).execute(text(query))
+    schema = export.arrow_schema(result.cursor.description)
+    rows = 0
+    for i, partition in enumerate(result.partitions(BATCH_SIZE)):
+        batch = export.arrow_table(partition, schema)
+        if partition_cols:
+            pq.write_to_dataset(batch, target, partition_cols=partition_cols, basename_template=f"part-{i}-{{i}}.parquet")
+        else:
+            os.makedirs(target, exist_ok=True)
+            pq.write_table(batch, os.path.join(target, f"part-{i}.parquet"))
+        rows += len(partition)
+    if not rows and not partition_cols:
+        # An empty dimension still needs a file for its view.
+        os.makedirs(target, exist_ok=True)
+        pq.write_table(export.arrow_table([], schema), os.path.join(target, "part-0.parquet"))
+    return rows
+
+
+def export_star_schema(source_url, directory=PARQUET_DIR):
+    # The new snapshot is written next to the current one and swapped in at
+    # the end, readers never see a half written directory.
+    staging = directory.rstrip("/") + ".staging"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    source = create_engine(source_url)
+    counts = {}
+    with source.connect() as conn:
+        for table in TABLES:
+            counts[table] = _export_table(conn, table, staging)
+        max_req_pk = conn.execute(text("SELECT MAX(req_pk) FROM factrequests")).scalar()
+    source.dispose()
+
+    manifest = {"exported_at": time.time(), "max_req_pk": max_req_pk, "rows": counts}
+    with open(_manifest_path(staging), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    previous = directory.rstrip("/") + ".previous"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, previous)
+    os.rename(staging, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+    return manifest
+
+
+def manifest(directory=PARQUET_DIR):
+    with open(_manifest_path(directory)) as f:
+        return json.load(f)
+
+
+def data_version(directory=PARQUET_DIR):
+    exported = manifest(directory)
+    return f"{exported['max_req_pk']}:{exported['exported_at']}"
+
+
+def create_duckdb_engine(directory=PARQUET_DIR):
+    engine = create_engine("duckdb:///:memory:")
+
+    @event.listens_for(engine, "connect")
+    def create_views(dbapi_connection, connection_record):
+        # Every connection gets views with the warehouse table names, so the
+        # endpoints run their SQL unchanged against the Parquet files.
+        for table in TABLES:
+            pattern = os.path.join(os.path.abspath(directory), table, "**", "*.parquet")
+            hive = ", hive_partitioning = true" if table in PARTITIONS else ""
+            dbapi_connection.execute(
+                f"CREATE OR REPLACE VIEW {table} AS SELECT * FROM read_parquet('{pattern}'{hive})"
+            )
+
+    return engine
+
+
+def main(argv=None):
+    from app import database
+
+    parser = argparse.ArgumentParser(description="Export the DW_SPN star schema to Parquet")
+    parser.add_argument("--source", default=database.SQLALCHEMY_DATABASE_URL)
+    parser.add_argument("--directory", default=PARQUET_DIR)
+    args = parser.parse_args(argv)
+
+    exported = export_star_schema(args.source, args.directory)
+    for table, rows in exported["rows"].items():
+        print(f"{table}: {rows} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import csv
+import importlib.util
+import io
+import json
+import re
+
+from app import database, filters
+
+FORMATS = {
+    "csv": {"media_type": "text/csv", "extension": "csv"},
+    "ndjson": {"media_type": "application/x-ndjson", "extension": "ndjson"},
+    "parquet": {"media_type": "application/vnd.apache.parquet", "extension": "parquet"},
+    "arrow": {"media_type": "application/vnd.apache.arrow.stream", "extension": "arrow"},
+}
+
+ARROW_FORMATS = ("parquet", "arrow")
+
+# The fact columns are listed: on the DuckDB backend the factrequests view
+# also carries the year/month partition columns.
+EXPORT_COLUMNS = (
+    "req_pk", "date_fk", "car_fk", "client_fk", "region_fk", "req_type_fk", "bench1_fk", "offer_fk",
+    "pick_up_date", "pick_up_place", "drop_off_place", "passenger_count_client",
+    "total_price", "offer_price", "prix_annuel",
+)
+
+# Dimension filters are resolved to fact keys, the export reads one table.
+EXPORT_QUERY = f"""
+    SELECT {", ".join("f." + column for column in EXPORT_COLUMNS)}
+    FROM factrequests f
+"""
+
+def arrow_available():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def export_statement(params):
+    return filters.compile_query(EXPORT_QUERY, params, {
+        "date_range": "f.pick_up_date",
+        "slug": "f.car_fk",
+        "offer": "f.offer_fk",
+        "source": "f.bench1_fk",
+        "dest_code": "f.region_fk",
+        "adjustement_type": "f.offer_fk",
+        "req_type": "f.req_type_fk",
+    }, " ORDER BY f.req_pk")
+
+
+# Postgres type OIDs -> arrow type names, NUMERIC (1700) is handled apart.
+PG_ARROW_TYPES = {
+    16: "bool", 20: "int64", 21: "int16", 23: "int32", 700: "float32", 701: "float64",
+    1082: "date32", 1114: "timestamp", 1184: "timestamptz",
+}
+NUMERIC_OID = 1700
+# DuckDB reports type names, matched by prefix in this order.
+DUCKDB_ARROW_TYPES = [
+    ("BOOLEAN", "bool"), ("BIGINT", "int64"), ("INTEGER", "int32"), ("SMALLINT", "int16"),
+    ("DOUBLE", "float64"), ("FLOAT", "float32"), ("DATE", "date32"),
+    ("TIMESTAMP WITH TIME ZONE", "timestamptz"), ("TIMESTAMP", "timestamp"),
+]
+
+
+def _arrow_type(pa, type_code, precision=None, scale=None):
+    types = {
+        "bool": pa.bool_(), "int64": pa.int64(), "int32": pa.int32(), "int16": pa.int16(),
+        "float64": pa.float64(), "float32": pa.float32(), "date32": pa.date32(),
+        "timestamp": pa.timestamp("us"), "timestamptz": pa.timestamp("us", tz="UTC"),
+    }
+    if type_code == NUMERIC_OID:
+        if precision and precision <= 38 and scale is not None and scale >= 0:
+            return pa.decimal128(precision, scale)
+        return pa.float64()
+    if isinstance(type_code, int):
+        return types.get(PG_ARROW_TYPES.get(type_code), pa.string())
+    name = str(type_code).upper()
+    decimal = re.match(r"DECIMAL\((\d+),\s*(\d+)\)", name)
+    if decimal:
+        return pa.decimal128(int(decimal.group(1)), int(decimal.group(2)))
+    for prefix, arrow_name in DUCKDB_ARROW_TYPES:
+        if name.startswith(prefix):
+            return types[arrow_name]
+    return pa.string()
+
+
+def arrow_schema(description):
+    # Built from the cursor description before the first row, a column that is
+    # NULL in the first batch keeps its real type and an empty result still
+    # has a schema.
+    import pyarrow as pa
+
+    fields = []
+    for column in description:
+        precision, scale = (column[4], column[5]) if len(column) > 5 else (None, None)
+        fields.append(pa.field(column[0], _arrow_type(pa, column[1], precision, scale)))
+    return pa.schema(fields)
+
+
+def arrow_table(rows, schema):
+    import pyarrow as pa
+
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for values, field in zip(columns, schema):
+        if pa.types.is_floating(field.type):
+            values = [None if v is None else float(v) for v in values]
+        elif pa.types.is_string(field.type):
+            values = [None if v is None else str(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def batches(statement, bound, batch_size):
+    # stream_results makes psycopg2 read through a named server-side cursor,
+    # only one batch of rows is held in memory at a time. The cursor
+    # description comes first, then the batches.
+    with database.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(statement, bound)
+        yield result.cursor.description
+        for partition in result.partitions(batch_size):
+            yield partition
+
+
+def _csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column[0] for column in next(rows)])
+    for batch in rows:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def _ndjson(rows):
+    keys = [column[0] for column in next(rows)]
+    for batch in rows:
+        yield "".join(
+            json.dumps(dict(zip(keys, row)), default=str) + "\n" for row in batch
+        ).encode()
+
+
+class _ChunkSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow(rows, fmt):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(next(rows))
+    sink = _ChunkSink()
+    stream = pa.PythonFile(sink, mode="w")
+    # Opened before the first batch so an empty result is still a valid file.
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(stream, schema)
+    else:
+        writer = pa.ipc.new_stream(stream, schema)
+    for batch in rows:
+        writer.write_table(arrow_table(batch, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream(fmt, statement, bound, batch_size):
+    rows = batches(statement, bound, batch_size)
+    if fmt == "csv":
+        return _csv(rows)
+    if fmt == "ndjson":
+        return _ndjson(rows)
+    return _arrow(rows, fmt)
@@ -0,0 +1,125 @@
+import functools
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, text
+
+from app import catalog
+
+# Date ranges are compiled to half-open ranges on the raw column so the
+# predicate stays sargable, end_date itself is still included.
+PREDICATES = {
+    "date_range": "{column} >= :start_date AND {column} < :end_date_exclusive",
+    "slug": "{column} = :slug",
+    "offer": "{column} = :offer",
+    "source": "{column} = :source",
+    "dest_code": "{column} = :dest_code",
+    "currency_code": "{column} = :currency_code",
+    "adjustement_type": "{column} = :adjustement_type",
+    "source_request": "{column} = :source_request",
+    "isb2b": "{column} = :isb2b",
+    "req_type": "{column} = :req_type",
+}
+
+LIST_PREDICATE = "{column} IN :{name}"
+
+# Filters on a dimension attribute: name -> (dimension, attribute, key). When
+# an endpoint maps one to a fact foreign key (a column ending in _fk), the
+# catalog resolves the value to the set of keys and the fact table is
+# filtered without joining the dimension. dimdestinations has several rows
+# per region, joining it would count every fact row once per destination.
+KEY_FILTERS = {
+    "slug": ("dimcars", "slug", "car_pk"),
+    "dest_code": ("dimdestinations", "dest_code", "region_fk"),
+    "adjustement_type": ("dimoffers", "adjustement_type", "offer_pk"),
+    "req_type": ("dimrequesttypes", "req_type", "req_type_pk"),
+    "source": ("dimbenchmarks", "source", "benchmark_pk"),
+}
+# Used when the catalog is unavailable.
+KEY_SUBQUERY = "{column} IN (SELECT {key} FROM {dimension} WHERE {attribute} {condition})"
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value.strip(), "%Y-%m-%d").date()
+    except (AttributeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+
+
+def has_date_range(params):
+    return bool(params.get("start_date") and params.get("end_date"))
+
+
+def bind(params):
+    bound = dict(params)
+    if has_date_range(params):
+        bound["start_date"] = parse_date(params["start_date"])
+        bound["end_date"] = parse_date(params["end_date"])
+        bound["end_date_exclusive"] = bound["end_date"] + timedelta(days=1)
+    return bound
+
+
+def shape_of(params, columns):
+    shape = []
+    for name in columns:
+        if name == "date_range":
+            if has_date_range(params):
+                shape.append((name, False))
+            continue
+        value = params.get(name)
+        if value is None or value == "" or value == []:
+            continue
+        shape.append((name, isinstance(value, (list, tuple))))
+    return tuple(shape)
+
+
+@functools.lru_cache(maxsize=512)
+def _compile(base, columns, shape, tail):
+    column_of = dict(columns)
+    clauses = []
+    expanding = []
+    for name, is_list in shape:
+        if name in KEY_FILTERS and column_of[name].endswith("_fk"):
+            dimension, attribute, key = KEY_FILTERS[name]
+            condition = f"IN :{name}" if is_list else f"= :{name}"
+            clauses.append(KEY_SUBQUERY.format(column=column_of[name], key=key, dimension=dimension, attribute=attribute, condition=condition))
+            if is_list:
+                expanding.append(bindparam(name, expanding=True))
+        elif is_list:
+            clauses.append(LIST_PREDICATE.format(column=column_of[name], name=name))
+            expanding.append(bindparam(name, expanding=True))
+        else:
+            clauses.append(PREDICATES[name].format(column=column_of[name]))
+
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    statement = text(base + where + " " + tail)
+    if expanding:
+        statement = statement.bindparams(*expanding)
+    return statement
+
+
+def resolve_keys(params, columns):
+    params = dict(params)
+    columns = dict(columns)
+    for name, (dimension, attribute, _) in KEY_FILTERS.items():
+        value = params.get(name)
+        column = columns.get(name)
+        if value is None or value == "" or value == [] or not column or not column.endswith("_fk"):
+            continue
+        keys = catalog.keys(dimension, attribute, value if isinstance(value, (list, tuple)) else [value])
+        if keys is None:
+            continue
+        # No matching key: NULL never compares equal, the filter matches no row.
+        params[f"{name}_keys"] = keys or [None]
+        columns[f"{name}_keys"] = columns.pop(name)
+        del params[name]
+    return params, columns
+
+
+def compile_query(base, params, columns, tail=""):
+    # Compiled statements are cached per filter shape, i.e. per endpoint and
+    # set of filters actually supplied, not per filter value.
+    params, columns = resolve_keys(params, columns)
+    columns = tuple(columns.items())
+    shape = shape_of(params, dict(columns))
+    return _compile(base, columns, shape, tail), bind(params)
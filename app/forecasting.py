@@ -0,0 +1,248 @@
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.model_selection import train_test_split
+from sqlalchemy import text
+
+from app import data_version
+
+MODEL_DIR = os.getenv("SPN_MODEL_DIR", "models")
+
+# model name -> training target
+TARGETS = {
+    "total_price": "total_price",
+    "passenger_count": "passenger_count_client",
+}
+
+# One row per day: the models are fitted on daily means weighted by the number
+# of requests, which gives the same trend as a fit on the individual requests.
+TRAINING_QUERY = """
+    SELECT
+        d.date,
+        d.id_mois AS month,
+        d.trimestre AS quarter,
+        EXTRACT(ISODOW FROM d.date)::int AS weekday,
+        COUNT(f.req_pk) AS request_count,
+        SUM(f.total_price) AS total_price_sum,
+        AVG(f.total_price)::float8 AS total_price,
+        SUM(f.passenger_count_client) AS passenger_count_sum,
+        AVG(f.passenger_count_client)::float8 AS passenger_count_client
+    FROM factrequests f
+    JOIN dimdates d ON f.date_fk = d.date_pk
+    GROUP BY d.date, d.id_mois, d.trimestre
+    ORDER BY d.date
+"""
+
+# Stored with every model, models fitted on another feature layout are retrained.
+FEATURES = "date+month+quarter+weekday"
+
+TRAINING_COLUMNS = [
+    "date", "month", "quarter", "weekday", "request_count",
+    "total_price_sum", "total_price", "passenger_count_sum", "passenger_count_client",
+]
+
+VEHICLE_CAPACITY = 4
+TARGET_UTILIZATION = 0.85
+
+MAX_BATCH_DATES = int(os.getenv("SPN_FORECAST_MAX_DATES", "3660"))
+
+FREQUENCIES = {"day": "D", "week": "W-MON", "month": "MS"}
+
+_lock = threading.Lock()
+_registry = {}
+_loaded = False
+
+
+def date_numeric(dates):
+    return (pd.to_datetime(dates) - pd.Timestamp("1970-01-01")) // pd.Timedelta("1D")
+
+
+def _one_hot(values, categories):
+    # The first category is dropped, it is carried by the intercept.
+    return (np.asarray(values)[:, None] == np.asarray(categories[1:])[None, :]).astype(np.float64)
+
+
+def calendar_features(day_numbers, months, quarters, weekdays):
+    return np.column_stack([
+        np.asarray(day_numbers, dtype=np.float64),
+        _one_hot(months, range(1, 13)),
+        _one_hot(quarters, range(1, 5)),
+        _one_hot(weekdays, range(1, 8)),
+    ])
+
+
+def features_for(days):
+    days = pd.DatetimeIndex(pd.to_datetime(days))
+    return calendar_features(
+        date_numeric(days),
+        days.month,
+        days.quarter,
+        days.dayofweek + 1,
+    )
+
+
+def _paths(name):
+    return (
+        os.path.join(MODEL_DIR, f"{name}.joblib"),
+        os.path.join(MODEL_DIR, f"{name}.json"),
+    )
+
+
+def _replace(path, write):
+    # Written next to the target and renamed over it: other workers loading
+    # the model never see a partly written file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _dump_json(metadata, path):
+    with open(path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def _fit(X, df, target):
+    y = df[target].to_numpy(dtype=np.float64)
+    weights = df["request_count"].to_numpy(dtype=np.float64)
+
+    X_train, X_test, y_train, y_test, w_train, w_test = train_test_split(
+        X, y, weights, test_size=0.2, random_state=0
+    )
+
+    model = LinearRegression()
+    model.fit(X_train, y_train, sample_weight=w_train)
+
+    predictions = model.predict(X_test)
+    metrics = {
+        "r2": float(r2_score(y_test, predictions, sample_weight=w_test)),
+        "mae": float(mean_absolute_error(y_test, predictions, sample_weight=w_test)),
+    }
+    return model, metrics
+
+
+def train(db, version=None):
+    version = version or data_version.current()
+    result = db.execute(text(TRAINING_QUERY))
+    df = pd.DataFrame(result.fetchall(), columns=TRAINING_COLUMNS)
+    df = df.dropna(subset=["total_price", "passenger_count_client"])
+    if df.empty:
+        raise ValueError("No training data")
+
+    df["date"] = pd.to_datetime(df["date"])
+    X = calendar_features(date_numeric(df["date"]), df["month"], df["quarter"], df["weekday"])
+
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    trained = {}
+    for name, target in TARGETS.items():
+        model, metrics = _fit(X, df, target)
+        metadata = {
+            "name": name,
+            "target": target,
+            "data_version": version,
+            "features": FEATURES,
+            "trained_at": datetime.now(timezone.utc).isoformat(),
+            "training_window": {
+                "start": df["date"].min().strftime("%Y-%m-%d"),
+                "end": df["date"].max().strftime("%Y-%m-%d"),
+            },
+            "row_count": int(len(df)),
+            "request_count": int(df["request_count"].sum()),
+            "metrics": metrics,
+        }
+        model_path, metadata_path = _paths(name)
+        _replace(model_path, lambda path: joblib.dump(model, path))
+        _replace(metadata_path, lambda path: _dump_json(metadata, path))
+        trained[name] = {"model": model, "metadata": metadata}
+
+    _registry.update(trained)
+    return [entry["metadata"] for entry in trained.values()]
+
+
+def load():
+    global _loaded
+    for name in TARGETS:
+        model_path, metadata_path = _paths(name)
+        if os.path.exists(model_path) and os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            _registry[name] = {"model": joblib.load(model_path), "metadata": metadata}
+    _loaded = True
+    return info()
+
+
+def ensure_loaded():
+    # Persisted models are read on first use, not when the worker starts.
+    if not _loaded:
+        with _lock:
+            if not _loaded:
+                load()
+
+
+def _is_current(version):
+    return all(
+        name in _registry
+        and _registry[name]["metadata"]["data_version"] == version
+        and _registry[name]["metadata"].get("features") == FEATURES
+        for name in TARGETS
+    )
+
+
+def get_model(name, db):
+    ensure_loaded()
+    try:
+        version = data_version.current()
+    except Exception:
+        # Without a reachable database the last persisted model keeps serving.
+        if name in _registry:
+            return _registry[name]["model"]
+        raise
+
+    if not _is_current(version):
+        with _lock:
+            if not _is_current(version):
+                # Another worker may already have trained for this version.
+                load()
+            if not _is_current(version):
+                train(db, version)
+    return _registry[name]["model"]
+
+
+def retrain(db, version=None):
+    with _lock:
+        return train(db, version)
+
+
+def predict(name, day, db):
+    model = get_model(name, db)
+    return model.predict(features_for([day]))[0]
+
+
+def forecast_dates(start, end, granularity="day"):
+    return pd.date_range(start, end, freq=FREQUENCIES[granularity])
+
+
+def forecast(days, db):
+    # Every date goes through each fitted model in a single predict call.
+    x = features_for(days)
+    prices = get_model("total_price", db).predict(x)
+    passengers = np.ceil(get_model("passenger_count", db).predict(x))
+    fleet = np.ceil(passengers / VEHICLE_CAPACITY)
+    adjusted_fleet = np.ceil(fleet / TARGET_UTILIZATION)
+    return prices, passengers, fleet, adjusted_fleet
+
+
+def info():
+    return [_registry[name]["metadata"] for name in TARGETS if name in _registry]
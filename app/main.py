@@ -1,22 +1,23 @@
 from fastapi import FastAPI, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from sqlalchemy import text
-from app import database, schemas
+from app import cache, catalog, compression, conditional, data_version, database, export, filters, metrics, pool_metrics, precompute, retention, rollups, schemas, serialization, singleflight, slow_queries, snapshot, warmup
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional, Dict, Any
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LinearRegression
+import asyncio
+import functools
+import inspect
 import math
 
 from datetime import datetime
 
-app = FastAPI()
-
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-
-app = FastAPI()
+app = FastAPI(default_response_class=serialization.JSONBytesResponse)
+app.router.route_class = metrics.TimedRoute
+app.middleware("http")(metrics.track_request)
+app.add_middleware(compression.CompressionMiddleware)
+app.add_middleware(conditional.ConditionalMiddleware)
 
 origins = [
     "http://localhost:4000",
@@ -31,12 +32,82 @@ app.add_middleware(
 )
 
 
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+get_db = database.get_db
+
+@app.on_event("startup")
+def load_snapshot():
+    if snapshot.ENABLED:
+        snapshot.start()
+
+
+@app.post("/admin/rollups/refresh", response_model=List[str])
+def refresh_rollups(db: Session = Depends(get_db)):
+    refreshed = rollups.refresh(db)
+    cache.clear()
+    return refreshed
+
+
+@app.get("/admin/snapshot")
+def get_snapshot_info():
+    return snapshot.info()
+
+
+@app.post("/admin/snapshot/refresh")
+def refresh_snapshot():
+    snapshot.refresh()
+    cache.clear()
+    return snapshot.info()
+
+
+@app.get("/ready", include_in_schema=False)
+def get_readiness():
+    return serialization.JSONBytesResponse(warmup.info(), status_code=200 if warmup.ready() else 503)
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/pool")
+def get_pool_stats():
+    return pool_metrics.snapshot()
+
+
+@app.get("/admin/slow-queries")
+def get_slow_queries(limit: int = Query(50, ge=1, le=slow_queries.RECENT_SIZE)):
+    return {"stats": slow_queries.info(), "queries": slow_queries.recent(limit)}
+
+
+@app.get("/admin/slow-queries/plans")
+def get_slow_query_plans(limit: int = Query(20, ge=1, le=200)):
+    return slow_queries.plans(limit)
+
+
+@app.get("/admin/cache")
+def get_cache_stats():
+    return cache.stats()
+
+
+@app.get("/admin/singleflight")
+def get_singleflight_stats(top: int = Query(20, ge=1, le=singleflight.MAX_TRACKED_KEYS)):
+    return singleflight.group.stats(top)
+
+
+@app.get("/admin/catalog")
+def get_catalog_info():
+    return catalog.info()
+
+
+@app.get("/admin/precompute")
+def get_precompute_status(top: int = Query(20, ge=1, le=precompute.MAX_TRACKED)):
+    return precompute.info(top)
+
+
+@app.delete("/admin/cache")
+def clear_cache():
+    cache.clear()
+    return cache.stats()
 
 def common_query_params(
     start_date: Optional[str] = Query(None),
@@ -66,7 +137,8 @@ def common_query_params(
     }
 
 @app.get("/growth_kpi/", response_model=schemas.GrowthKPI)
-def get_growth_kpi(db: Session = Depends(get_db)):
+@singleflight.coalesce
+async def get_growth_kpi():
     gain_2022_query = text("""
         SELECT COALESCE(SUM(f.total_price - f.offer_price) - MIN(f.prix_annuel), 0) as gain
         FROM factrequests f
@@ -88,9 +160,11 @@ def get_growth_kpi(db: Session = Depends(get_db)):
         WHERE d."Annee" = 2024
     """)
     
-    gain_2022 = db.execute(gain_2022_query).scalar()
-    gain_2023 = db.execute(gain_2023_query).scalar()
-    gain_2024 = db.execute(gain_2024_query).scalar()
+    gain_2022, gain_2023, gain_2024 = await asyncio.gather(
+        database.fetch_scalar(gain_2022_query),
+        database.fetch_scalar(gain_2023_query),
+        database.fetch_scalar(gain_2024_query),
+    )
     
     if gain_2022 is None or gain_2023 is None or gain_2024 is None:
         raise HTTPException(status_code=404, detail="Data not found")
@@ -107,6 +181,7 @@ def get_growth_kpi(db: Session = Depends(get_db)):
     )
 
 @app.get("/factrequests/gain", response_model=schemas.FactRequestGain)
+@cache.kpi_cache
 def read_factrequest_gain(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
@@ -117,21 +192,15 @@ def read_factrequest_gain(
             SUM(total_price - offer_price) as total_gain
         FROM factrequests f
         JOIN dimdates d ON f.date_fk = d.date_pk
-        JOIN dimcars c ON f.car_fk = c.car_pk
         JOIN dimClients cl ON f.client_fk = cl.client_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND d.date BETWEEN :start_date AND :end_date"
-    if params.get("slug"):
-        filters += " AND c.slug = :slug"
-    
-    query = query + filters + " GROUP BY cl.customer"
-    
-    query += " ORDER BY total_gain DESC LIMIT 10"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "d.date",
+        "slug": "f.car_fk"
+    }, " GROUP BY cl.customer ORDER BY total_gain DESC LIMIT 10")
     
-    results = db.execute(text(query), params).fetchall()
+    results = db.execute(statement, bound).fetchall()
     
     if not results:
         raise HTTPException(status_code=404, detail="Data not found")
@@ -150,38 +219,40 @@ def read_factrequest_gain(
 
 
 @app.get("/brand-gains/", response_model=schemas.BrandGainsKPI)
+@cache.kpi_cache
 def get_car_type_gains(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
-    base_query = """
+    source = rollups.source_for("car_fk", "pick_up_day")
+    base_query = f"""
         SELECT 
-            c.brand as brand,
-            SUM(f.total_price - f.offer_price) as total_gain
+            f.car_fk,
+            {source["gain"]} as total_gain
         FROM 
-            factrequests f
-        JOIN
-            dimcars c ON f.car_fk = c.car_pk
+            {source["table"]} f
     """
 
-    filters = "WHERE 1=1"
-    if params.get("slug"):
-        filters += " AND c.slug = :slug"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    final_query = base_query + filters + " GROUP BY c.brand"
+    statement, bound = filters.compile_query(base_query, params, {
+        "slug": "f.car_fk",
+        "date_range": source["day"]
+    }, " GROUP BY f.car_fk")
     
     try:
-        results = db.execute(text(final_query), params).fetchall()
+        if snapshot.active():
+            results = [row._asdict() for row in snapshot.brand_gains(params)]
+        else:
+            results = catalog.attach_labels(
+                db.execute(statement, bound), {"car_fk": ("dimcars", "brand", "brand")}, ("total_gain",)
+            )
         
         if not results:
             raise HTTPException(status_code=404, detail="Data not found")
         
         data = [
             {
-                "brand": row.brand.strip(), 
-                "total_gain": round(row.total_gain,2)
+                "brand": row["brand"].strip(), 
+                "total_gain": round(row["total_gain"],2)
             }
             for row in results
         ]
@@ -192,48 +263,38 @@ def get_car_type_gains(
 
     
 @app.get("/car_clients_kpi/", response_model=schemas.CarClientsKPI)
+@cache.kpi_cache
 def get_car_clients_kpi(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     query = """
         SELECT
-            c.brand,
-            r.req_type,
+            f.car_fk,
+            f.req_type_fk,
             COUNT(cl.client_pk) as client_count
         FROM factrequests f
-        JOIN dimcars c ON f.car_fk = c.car_pk
         JOIN dimclients cl ON f.client_fk = cl.client_pk
-        JOIN dimrequesttypes r ON f.req_type_fk = r.req_type_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("slug"):
-        filters += " AND c.slug = :slug"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    query = query + filters + " GROUP BY c.brand, r.req_type"
+    statement, bound = filters.compile_query(query, params, {
+        "slug": "f.car_fk",
+        "date_range": "f.pick_up_date"
+    }, " GROUP BY f.car_fk, f.req_type_fk")
     
-    results = db.execute(text(query), params).fetchall()
+    data = catalog.attach_labels(db.execute(statement, bound), {
+        "car_fk": ("dimcars", "brand", "brand"),
+        "req_type_fk": ("dimrequesttypes", "req_type", "req_type"),
+    }, ("client_count",))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.CarClientsData(
-            brand=row.brand.strip(),
-            req_type=row.req_type.strip(),
-            client_count=row.client_count
-        )
-        for row in results
-    ]
-    
-    return schemas.CarClientsKPI(data=data)
+    return serialization.data_response(data)
 
 @app.get("/car_owners_kpi/", response_model=schemas.CarOwnersKPI)
-def get_car_owners_kpi(
-    db: Session = Depends(get_db),
+@cache.kpi_cache
+async def get_car_owners_kpi(
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     car_count_query = """
@@ -243,11 +304,9 @@ def get_car_owners_kpi(
         FROM dimcars
     """
     
-    filters = "WHERE 1=1"
-    if params.get("slug"):
-        filters += " AND slug = :slug"
-
-    car_count_query = car_count_query + filters + " GROUP BY COALESCE(owner, 'Unknown')"
+    car_count_statement, car_count_bound = filters.compile_query(car_count_query, params, {
+        "slug": "slug"
+    }, " GROUP BY COALESCE(owner, 'Unknown')")
 
     request_count_query = """
         SELECT
@@ -257,17 +316,17 @@ def get_car_owners_kpi(
         JOIN dimcars c ON f.car_fk = c.car_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("slug"):
-        filters += " AND c.slug = :slug"
-
-    request_count_query = request_count_query + filters + " GROUP BY COALESCE(c.owner, 'Unknown')"
+    request_count_statement, request_count_bound = filters.compile_query(request_count_query, params, {
+        "slug": "c.slug"
+    }, " GROUP BY COALESCE(c.owner, 'Unknown')")
 
     total_requests_query = "SELECT COUNT(*) as total_requests FROM factrequests"
 
-    car_count_results = db.execute(text(car_count_query), params).fetchall()
-    request_count_results = db.execute(text(request_count_query), params).fetchall()
-    total_requests = db.execute(text(total_requests_query)).scalar()
+    car_count_results, request_count_results, total_requests = await asyncio.gather(
+        database.fetch_all(car_count_statement, car_count_bound),
+        database.fetch_all(request_count_statement, request_count_bound),
+        database.fetch_scalar(text(total_requests_query)),
+    )
 
     if not car_count_results or not request_count_results or total_requests is None:
         raise HTTPException(status_code=404, detail="Data not found")
@@ -285,72 +344,79 @@ def get_car_owners_kpi(
     return schemas.CarOwnersKPI(data=data)
 
 
+def _top(rows, measure, limit=None):
+    # Aggregates are merged on their labels in Python, ordering and limits
+    # are applied afterwards.
+    rows = sorted(rows, key=lambda row: row[measure], reverse=True)
+    return rows[:limit] if limit else rows
+
+
+def _benchmark_regions(results):
+    return catalog.attach_labels(results, {
+        "bench1_fk": ("dimbenchmarks", "source", "source"),
+        "region_fk": ("dimregions", "pays", "region"),
+    }, ("request_count",))
+
+
 @app.get("/requests_per_benchmark_by_source_and_region/", response_model=schemas.RequestsPerBenchmarkBySourceAndRegion)
+@cache.kpi_cache
 def get_requests_per_benchmark_by_source_and_region(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     query = """
         SELECT
-            b.source,
-            r.pays as region,
-            COUNT(f.req_pk) as request_count
+            f.bench1_fk,
+            f.region_fk,
+            COUNT(*) as request_count
         FROM factrequests f
-        JOIN dimbenchmarks b ON f.bench1_fk = b.benchmark_pk
-        JOIN dimregions r ON f.region_fk = r.region_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    query = query + filters + " GROUP BY b.source, r.pays ORDER BY request_count DESC LIMIT 10"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "f.pick_up_date"
+    }, " GROUP BY f.bench1_fk, f.region_fk")
 
-    results = db.execute(text(query), params).fetchall()
+    results = _top(_benchmark_regions(db.execute(statement, bound)), "request_count", 10)
     
     if not results:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.BenchmarkBySourceAndRegionData(
-            source=row.source.strip(), 
-            region=row.region.strip(), 
-            request_count=row.request_count
-        )
-        for row in results
-    ]
+    data = [schemas.BenchmarkBySourceAndRegionData(**row) for row in results]
     
     return schemas.RequestsPerBenchmarkBySourceAndRegion(data=data)
 
 
 @app.get("/requests_per_offer/", response_model=schemas.RequestsPerOffer)
+@cache.kpi_cache
 def get_requests_per_offer(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     query = """
         SELECT
-            o.adjustement_type,
-            COUNT(f.req_pk) as request_count
+            f.offer_fk,
+            COUNT(*) as request_count
         FROM factrequests f
-        JOIN dimoffers o ON f.offer_fk = o.offer_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    query = query + filters + " GROUP BY o.adjustement_type"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "f.pick_up_date"
+    }, " GROUP BY f.offer_fk")
 
-    results = db.execute(text(query), params).fetchall()
+    if snapshot.active():
+        results = [row._asdict() for row in snapshot.requests_per_offer(params)]
+    else:
+        results = catalog.attach_labels(
+            db.execute(statement, bound), {"offer_fk": ("dimoffers", "adjustement_type", "adjustement_type")}, ("request_count",)
+        )
     
     if not results:
         raise HTTPException(status_code=404, detail="Data not found")
     
     data = [
         schemas.OfferData(
-            adjustement_type=row.adjustement_type.strip(), 
-            request_count=row.request_count
+            adjustement_type=row["adjustement_type"].strip(), 
+            request_count=row["request_count"]
         )
         for row in results
     ]
@@ -358,6 +424,7 @@ def get_requests_per_offer(
     return schemas.RequestsPerOffer(data=data)
 
 @app.get("/clients_percentage_per_car_type_and_request_type/", response_model=schemas.ClientsPercentagePerCarTypeAndRequestType)
+@cache.kpi_cache
 def get_clients_percentage_per_car_type_and_request_type(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
@@ -370,21 +437,15 @@ def get_clients_percentage_per_car_type_and_request_type(
         FROM factrequests f
         JOIN dimcars c ON f.car_fk = c.car_pk
         JOIN dimrequesttypes r ON f.req_type_fk = r.req_type_pk
-        JOIN dimregions AS dr ON f.region_fk = dr.region_pk
-        JOIN dimdestinations AS dd ON dr.region_pk = dd.region_fk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("slug"):
-        filters += " AND c.slug = :slug"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-    if params.get("dest_code"):
-        filters += " AND dd.dest_code = :dest_code"
-
-    query = query + filters + " GROUP BY c.sub_type, r.req_type"
+    statement, bound = filters.compile_query(query, params, {
+        "slug": "c.slug",
+        "date_range": "f.pick_up_date",
+        "dest_code": "f.region_fk"
+    }, " GROUP BY c.sub_type, r.req_type")
 
-    results = db.execute(text(query), params).fetchall()
+    results = db.execute(statement, bound).fetchall()
 
     if not results:
         raise HTTPException(status_code=404, detail="Data not found")
@@ -413,143 +474,111 @@ def get_clients_percentage_per_car_type_and_request_type(
 
 
 @app.get("/most_popular_requests/", response_model=schemas.MostPopularRequests)
+@cache.kpi_cache
 def get_most_popular_requests(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     query = """
         SELECT
-            r.req_type as request_type,
-            COUNT(f.req_pk) as request_count
+            f.req_type_fk,
+            COUNT(*) as request_count
         FROM factrequests f
-        JOIN dimrequesttypes r ON f.req_type_fk = r.req_type_pk
-        JOIN dimregions AS dr ON f.region_fk = dr.region_pk
-        JOIN dimdestinations AS dd ON dr.region_pk = dd.region_fk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "f.pick_up_date",
+        "dest_code": "f.region_fk"
+    }, " GROUP BY f.req_type_fk")
 
-    if params.get("dest_code"):
-        filters += " AND dd.dest_code = :dest_code"
-
-    query = query + filters + " GROUP BY r.req_type ORDER BY request_count DESC LIMIT 10"
-
-    results = db.execute(text(query), params).fetchall()
+    results = _top(catalog.attach_labels(
+        db.execute(statement, bound), {"req_type_fk": ("dimrequesttypes", "req_type", "request_type")}, ("request_count",)
+    ), "request_count", 10)
     
     if not results:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.PopularRequestData(
-            request_type=row.request_type.strip(), 
-            request_count=row.request_count
-        )
-        for row in results
-    ]
+    data = [schemas.PopularRequestData(**row) for row in results]
     
     return schemas.MostPopularRequests(data=data)
 
 @app.get("/benchmark_performance_by_region/", response_model=schemas.BenchmarkPerformanceByRegion)
+@cache.kpi_cache
 def get_benchmark_performance_by_region(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     query = """
         SELECT
-            b.source,
-            r.pays as region,
-            COUNT(f.req_pk) as request_count
+            f.bench1_fk,
+            f.region_fk,
+            COUNT(*) as request_count
         FROM factrequests f
-        JOIN dimbenchmarks b ON f.bench1_fk = b.benchmark_pk
-        JOIN dimregions r ON f.region_fk = r.region_pk
-        JOIN dimdestinations AS dd ON r.region_pk = dd.region_fk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "f.pick_up_date",
+        "dest_code": "f.region_fk"
+    }, " GROUP BY f.bench1_fk, f.region_fk")
 
-    if params.get("dest_code"):
-        filters += " AND dd.dest_code = :dest_code"
-
-    query = query + filters + " GROUP BY b.source, r.pays ORDER BY request_count DESC LIMIT 10"
-
-    results = db.execute(text(query), params).fetchall()
+    results = _top(_benchmark_regions(db.execute(statement, bound)), "request_count", 10)
     
     if not results:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.BenchmarkPerformanceData(
-            source=row.source.strip(), 
-            region=row.region.strip(), 
-            request_count=row.request_count
-        )
-        for row in results
-    ]
+    data = [schemas.BenchmarkPerformanceData(**row) for row in results]
     
     return schemas.BenchmarkPerformanceByRegion(data=data)
 
 
 @app.get("/revenue_by_offer_and_date/", response_model=schemas.RevenueByOfferAndDate)
+@cache.kpi_cache
 def get_revenue_by_offer_and_date(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     query = """
         SELECT
-            o.offer_code,
-            d.date,
-            SUM(f.total_price) as revenue
+            TRIM(o.offer_code) as offer_code,
+            d.date::text as date,
+            ROUND(SUM(f.total_price), 2)::float8 as revenue
         FROM factrequests f
         JOIN dimoffers o ON f.offer_fk = o.offer_pk
         JOIN dimdates d ON f.date_fk = d.date_pk
-        JOIN dimoffers AS doff ON f.offer_fk = doff.offer_pk
     """
     
-    filters = "WHERE 1=1 "
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    if params.get("adjustement_type"):
-        filters += "AND doff.adjustement_type = :adjustement_type "
-
-    query = query + filters + " GROUP BY o.offer_code, d.date , d.date LIMIT 5"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "f.pick_up_date",
+        "adjustement_type": "f.offer_fk"
+    }, " GROUP BY o.offer_code, d.date LIMIT 5")
 
-    results = db.execute(text(query), params).fetchall()
+    data = serialization.records(db.execute(statement, bound))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.OfferRevenueData(
-            offer_code=row.offer_code.strip(), 
-            date=row.date.strftime('%Y-%m-%d'), 
-            revenue=round(row.revenue,2)
-        )
-        for row in results
-    ]
-    
-    return schemas.RevenueByOfferAndDate(data=data)
+    return serialization.data_response(data)
 
 
 @app.get("/charge_kpi/", response_model=schemas.ChargeKPI)
+@cache.kpi_cache
 def get_charge_kpi(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
-    query = """
+    source = rollups.source_for("pick_up_day")
+    query = f"""
         SELECT SUM(f.prix_annuel) as total_charge
-        FROM factrequests f
+        FROM {source["table"]} f
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    result = db.execute(text(query + " " + filters), params).scalar()
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": source["day"]
+    })
+    if snapshot.active():
+        result = snapshot.total_charge(params)
+    else:
+        result = db.execute(statement, bound).scalar()
     
     if result is None:
         raise HTTPException(status_code=404, detail="Data not found")
@@ -559,166 +588,134 @@ def get_charge_kpi(
 
 
 @app.get("/most_revenue_generating_countries/", response_model=schemas.MostRevenueGeneratingCountries)
+@cache.kpi_cache
 def get_most_revenue_generating_countries(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
     query = """
         SELECT
-            r.pays as country,
-            SUM(f.total_price) as total_revenue
+            f.region_fk,
+            SUM(f.total_price)::float8 as total_revenue
         FROM factrequests f
-        JOIN dimregions r ON f.region_fk = r.region_pk
-        JOIN dimdestinations AS dd ON r.region_pk = dd.region_fk
-        
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    
-    if params.get("dest_code"):
-        filters += " AND dd.dest_code = :dest_code"
-
-    query = query + filters + " GROUP BY r.pays ORDER BY total_revenue DESC "
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "f.pick_up_date",
+        "dest_code": "f.region_fk"
+    }, " GROUP BY f.region_fk")
 
-    results = db.execute(text(query), params).fetchall()
+    data = _top(catalog.attach_labels(
+        db.execute(statement, bound), {"region_fk": ("dimregions", "pays", "country")}, ("total_revenue",)
+    ), "total_revenue")
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.RevenueGeneratingCountry(
-            country=row.country.strip(), 
-            total_revenue=row.total_revenue
-        )
-        for row in results
-    ]
-    
-    return schemas.MostRevenueGeneratingCountries(data=data)
+    return serialization.data_response(data)
 
 
-@app.get("/revenue_over_time_per_benchmark/", response_model=schemas.RevenueOverTimeResponse)
+@app.get("/revenue_over_time_per_benchmark/", response_model=schemas.RevenueOverTimeResponse, responses=serialization.FORMAT_RESPONSES)
+@cache.kpi_cache
 def get_revenue_over_time_per_benchmark(
     db: Session = Depends(get_db),
-    params: Dict[str, Any] = Depends(common_query_params)
+    params: Dict[str, Any] = Depends(common_query_params),
+    format: str = Depends(serialization.response_format)
 ):
-    query = """
+    source = rollups.source_for("date_fk", "bench1_fk", "pick_up_day")
+    query = f"""
         SELECT
-            d.date,
-            b.source,
-            SUM(f.total_price) as total_revenue
-        FROM factrequests f
+            d.date::text as date,
+            TRIM(b.source) as source,
+            SUM(f.total_price)::float8 as total_revenue
+        FROM {source["table"]} f
         JOIN dimdates d ON f.date_fk = d.date_pk
         JOIN dimbenchmarks b ON f.bench1_fk = b.benchmark_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    query = query + filters + " GROUP BY d.date, b.source ORDER BY total_revenue DESC LIMIT 20"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": source["day"]
+    }, " GROUP BY d.date, b.source ORDER BY total_revenue DESC LIMIT 20")
 
-    results = db.execute(text(query), params).fetchall()
+    data = serialization.records(db.execute(statement, bound))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.RevenueOverTimeData(
-            date=row.date.strftime('%Y-%m-%d'), 
-            source=row.source.strip(), 
-            total_revenue=row.total_revenue
-        )
-        for row in results
-    ]
-    
-    return schemas.RevenueOverTimeResponse(data=data)
+    return serialization.formatted_response(data, format)
 
 
-@app.get("/timeline_kpi/", response_model=schemas.TimelineKPIResponse)
+@app.get("/timeline_kpi/", response_model=schemas.TimelineKPIResponse, responses=serialization.FORMAT_RESPONSES)
+@cache.kpi_cache
 def get_timeline_kpi(
     db: Session = Depends(get_db),
-    params: Dict[str, Any] = Depends(common_query_params)
+    params: Dict[str, Any] = Depends(common_query_params),
+    format: str = Depends(serialization.response_format)
 ):
-    query = """
+    source = rollups.source_for("date_fk", "pick_up_day")
+    query = f"""
         SELECT
-            d.date,
-            COUNT(f.req_pk) as request_count,
-            SUM(f.total_price) as total_revenue
-        FROM factrequests f
+            d.date::text as date,
+            {source["count"]}::bigint as request_count,
+            SUM(f.total_price)::float8 as total_revenue
+        FROM {source["table"]} f
         JOIN dimdates d ON f.date_fk = d.date_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": source["day"]
+    }, " GROUP BY d.date ORDER BY d.date")
 
-    query = query + filters + " GROUP BY d.date ORDER BY d.date"
-
-    results = db.execute(text(query), params).fetchall()
+    if snapshot.active():
+        data = [
+            {"date": row.date.isoformat(), "request_count": row.request_count, "total_revenue": row.total_revenue}
+            for row in snapshot.timeline(params)
+        ]
+    else:
+        data = serialization.records(db.execute(statement, bound))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.TimelineKPIData(
-            date=row.date.strftime('%Y-%m-%d'), 
-            request_count=row.request_count, 
-            total_revenue=row.total_revenue
-        )
-        for row in results
-    ]
-    
-    return schemas.TimelineKPIResponse(data=data)
+    return serialization.formatted_response(data, format)
 
 
 
 
 
 
-@app.get("/quarterly_revenue_per_request_type/", response_model=schemas.QuarterlyRevenueResponse)
+@app.get("/quarterly_revenue_per_request_type/", response_model=schemas.QuarterlyRevenueResponse, responses=serialization.FORMAT_RESPONSES)
+@cache.kpi_cache
 def get_quarterly_revenue_per_request_type(
     db: Session = Depends(get_db),
-    params: Dict[str, Any] = Depends(common_query_params)
+    params: Dict[str, Any] = Depends(common_query_params),
+    format: str = Depends(serialization.response_format)
 ):
-    query = """
+    source = rollups.source_for("date_fk", "req_type_fk", "pick_up_day")
+    query = f"""
         SELECT
             CONCAT(d."Annee", ' Q', d.trimestre) as quarter,
-            rt.req_type as request_type,
-            SUM(f.total_price) as total_revenue
-        FROM factrequests f
+            TRIM(rt.req_type) as request_type,
+            SUM(f.total_price)::float8 as total_revenue
+        FROM {source["table"]} f
         JOIN dimdates d ON f.date_fk = d.date_pk
         JOIN dimrequesttypes rt ON f.req_type_fk = rt.req_type_pk
     """
     
-    filters = "WHERE 1=1 "
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    if params.get("req_type"):
-        filters += "AND rt.req_type = :req_type "
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": source["day"],
+        "req_type": "f.req_type_fk"
+    }, " GROUP BY CONCAT(d.\"Annee\", ' Q', d.trimestre), rt.req_type ORDER BY quarter")
 
-    query = query + filters + " GROUP BY CONCAT(d.\"Annee\", ' Q', d.trimestre), rt.req_type ORDER BY quarter"
-
-    results = db.execute(text(query), params).fetchall()
+    data = serialization.records(db.execute(statement, bound))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.QuarterlyRevenueData(
-            quarter=row.quarter, 
-            request_type=row.request_type.strip(), 
-            total_revenue=row.total_revenue
-        )
-        for row in results
-    ]
-    
-    return schemas.QuarterlyRevenueResponse(data=data)
+    return serialization.formatted_response(data, format)
 
 @app.get("/total_amount_and_percentage_gain_per_month/", response_model=schemas.MonthlyGainResponse)
+@cache.kpi_cache
 def get_total_amount_and_percentage_gain_per_month(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
@@ -736,31 +733,22 @@ def get_total_amount_and_percentage_gain_per_month(
             ORDER BY d."Annee", d.id_mois
         )
         SELECT
-            md."Annee",
-            md.month,
-            md.total_amount,
-            (md.total_amount - COALESCE(lag(md.total_amount) OVER (PARTITION BY md."Annee" ORDER BY md.id_mois), 0)) / NULLIF(md.total_amount, 0) * 100 as percentage_gain
+            md."Annee" as year,
+            TRIM(md.month) as month,
+            ROUND(md.total_amount, 2)::float8 as total_amount,
+            ROUND((md.total_amount - COALESCE(lag(md.total_amount) OVER (PARTITION BY md."Annee" ORDER BY md.id_mois), 0)) / NULLIF(md.total_amount, 0) * 100, 2)::float8 as percentage_gain
         FROM monthly_data md
     """
 
-    results = db.execute(text(query), params).fetchall()
+    data = serialization.records(db.execute(text(query), params))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.MonthlyGainData(
-            year=row.Annee, 
-            month=row.month.strip(), 
-            total_amount=round(row.total_amount,2), 
-            percentage_gain=round(row.percentage_gain,2)
-        )
-        for row in results
-    ]
-    
-    return schemas.MonthlyGainResponse(data=data)
+    return serialization.data_response(data)
 
 @app.get("/car_profitability_kpi/", response_model=schemas.CarProfitabilityResponse)
+@singleflight.coalesce
 def get_car_profitability_kpi(
     db: Session = Depends(get_db),
     slug: List[str] = Query(None),
@@ -770,141 +758,76 @@ def get_car_profitability_kpi(
     query = """
         SELECT
             c.brand || ' ' || c.plate_number as car_model,
-            COALESCE(SUM(f.total_price), 0) as total_revenue,
-            COALESCE(SUM(f.prix_annuel), 0) as prix_annuel,
-            COALESCE(SUM(f.total_price) - SUM(f.prix_annuel), 0) as profitability
+            COALESCE(SUM(f.total_price), 0)::float8 as total_revenue,
+            COALESCE(SUM(f.prix_annuel), 0)::float8 as prix_annuel,
+            COALESCE(SUM(f.total_price) - SUM(f.prix_annuel), 0)::float8 as profitability
         FROM factrequests f
         JOIN dimcars c ON f.car_fk = c.car_pk
     """
     
-    filters = "WHERE 1=1 "
-    params= {}
-    if slug:
-        filters += " AND c.slug IN :slug"
-        params['slug'] = tuple(slug)  # Convert list to tuple for SQL query
-    
-    if start_date and end_date:
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-        params['start_date'] = start_date
-        params['end_date'] = end_date
+    params = {"slug": slug, "start_date": start_date, "end_date": end_date}
+    statement, bound = filters.compile_query(query, params, {
+        "slug": "f.car_fk",
+        "date_range": "f.pick_up_date"
+    }, " GROUP BY car_model ORDER BY profitability DESC")
 
-    query = query + filters + " GROUP BY car_model ORDER BY profitability DESC"
-
-    results = db.execute(text(query), params).fetchall()
+    data = serialization.records(db.execute(statement, bound))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.CarProfitabilityData(
-            car_model=row.car_model, 
-            total_revenue=row.total_revenue, 
-            prix_annuel=row.prix_annuel, 
-            profitability=row.profitability
-        )
-        for row in results
-    ]
-    
-    return schemas.CarProfitabilityResponse(data=data)
+    return serialization.data_response(data)
 
-@app.get("/profit_total_and_other_charges/", response_model=schemas.ProfitChargesResponse)
+@app.get("/profit_total_and_other_charges/", response_model=schemas.ProfitChargesResponse, responses=serialization.FORMAT_RESPONSES)
+@cache.kpi_cache
 def get_profit_total_and_other_charges(
     db: Session = Depends(get_db),
-    params: Dict[str, Any] = Depends(common_query_params)
+    params: Dict[str, Any] = Depends(common_query_params),
+    format: str = Depends(serialization.response_format)
 ):
-    query = """
+    source = rollups.source_for("date_fk", "pick_up_day")
+    query = f"""
         SELECT
             d."Annee" || '-' || d.lib_mois as month,
-            COALESCE(SUM(f.total_price), 0) as total_revenue,
-            COALESCE(SUM(f.prix_annuel), 0) as other_charges,
-            COALESCE(SUM(f.total_price) - SUM(f.prix_annuel), 0) as total_profit
-        FROM factrequests f
+            COALESCE(SUM(f.total_price), 0)::float8 as total_revenue,
+            COALESCE(SUM(f.prix_annuel), 0)::float8 as other_charges,
+            COALESCE(SUM(f.total_price) - SUM(f.prix_annuel), 0)::float8 as total_profit
+        FROM {source["table"]} f
         JOIN dimdates d ON f.date_fk = d.date_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-
-    query = query + filters + " GROUP BY d.\"Annee\", d.lib_mois, d.id_mois ORDER BY d.\"Annee\", d.id_mois"
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": source["day"]
+    }, " GROUP BY d.\"Annee\", d.lib_mois, d.id_mois ORDER BY d.\"Annee\", d.id_mois")
 
-    results = db.execute(text(query), params).fetchall()
+    data = serialization.records(db.execute(statement, bound))
     
-    if not results:
+    if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    data = [
-        schemas.ProfitChargesData(
-            month=row.month, 
-            total_revenue=row.total_revenue, 
-            other_charges=row.other_charges, 
-            total_profit=row.total_profit
-        )
-        for row in results
-    ]
-    
-    return schemas.ProfitChargesResponse(data=data)
+    return serialization.formatted_response(data, format)
 
 @app.get("/car_rentation_rate_overtime", response_model=schemas.CarRentationRateKPI)
-def get_car_rentation_rate_overtime(db: Session = Depends(get_db)):
-    quarters_query = text("""
-        SELECT DISTINCT DATE_TRUNC('quarter', pick_up_date) AS quarter
-        FROM factrequests
-        WHERE pick_up_date <= CURRENT_DATE
-        ORDER BY quarter DESC
-        LIMIT 8
-    """)
-
-    quarters = db.execute(quarters_query).fetchall()
+@singleflight.coalesce
+async def get_car_rentation_rate_overtime(
+    granularity: str = Query("quarter", pattern="^(quarter|month|week)$"),
+    lookback: int = Query(8, ge=2, le=520)
+):
+    period_cars = await database.fetch_all(
+        retention.period_cars_query(granularity),
+        {"lookback": lookback}
+    )
     
-    if not quarters:
+    if not period_cars:
         raise HTTPException(status_code=404, detail="No data available")
 
-    rentation_rates = []
-    
-    for i in range(len(quarters) - 1):
-        current_quarter = quarters[i][0]
-        previous_quarter = quarters[i + 1][0]
-
-        current_car_query = text(f"""
-            SELECT DISTINCT car_fk
-            FROM factrequests
-            WHERE DATE_TRUNC('quarter', pick_up_date) = '{current_quarter}'
-        """)
-        
-        previous_car_query = text(f"""
-            SELECT DISTINCT car_fk
-            FROM factrequests
-            WHERE DATE_TRUNC('quarter', pick_up_date) = '{previous_quarter}'
-        """)
-        
-        current_car = db.execute(current_car_query).fetchall()
-        previous_car = db.execute(previous_car_query).fetchall()
-
-        current_car_set = set([row[0] for row in current_car])
-        previous_car_set = set([row[0] for row in previous_car])
-        
-        if not previous_car_set:
-            continue
-
-        new_car_set = current_car_set - previous_car_set
-        retained_car_set = current_car_set & previous_car_set
-
-
-        retained_car_count = len(retained_car_set)
-        previous_car_count = len(previous_car_set)
-
-        if previous_car_count == 0:
-            rentation_rate = 0
-        else:
-            rentation_rate = retained_car_count / previous_car_count
-
-
-        year = current_quarter.year
-        quarter = (current_quarter.month - 1) // 3 + 1
-        quarter_str = f"{year}-Q{quarter}"
-
-        rentation_rates.append(schemas.CarRentationRatePoint(quarter=quarter_str, rate=round(rentation_rate,2)))
+    rentation_rates = [
+        schemas.CarRentationRatePoint(
+            quarter=retention.period_label(granularity, period),
+            rate=round(rate, 2)
+        )
+        for period, rate in retention.retention_rates(period_cars)
+    ]
 
     if not rentation_rates:
         raise HTTPException(status_code=404, detail="Not enough data to calculate rentation rates")
@@ -913,6 +836,7 @@ def get_car_rentation_rate_overtime(db: Session = Depends(get_db)):
     return schemas.CarRentationRateKPI(data=rentation_data)
 
 @app.get("/top_pickup_places/", response_model=schemas.TopPlacesResponse)
+@cache.kpi_cache
 def get_top_pickup_places(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
@@ -922,19 +846,14 @@ def get_top_pickup_places(
             TRIM(f.pick_up_place) AS place,
             COUNT(*) AS request_count
         FROM factrequests f
-        JOIN dimregions AS dr ON f.region_fk = dr.region_pk
-        JOIN dimdestinations AS dd ON dr.region_pk = dd.region_fk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("dest_code"):
-        filters += " AND dd.dest_code = :dest_code"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
-    
-    query = query + filters + " GROUP BY f.pick_up_place ORDER BY request_count DESC LIMIT 10"
+    statement, bound = filters.compile_query(query, params, {
+        "dest_code": "f.region_fk",
+        "date_range": "f.pick_up_date"
+    }, " GROUP BY f.pick_up_place ORDER BY request_count DESC LIMIT 10")
     
-    results = db.execute(text(query), params).fetchall()
+    results = db.execute(statement, bound).fetchall()
     
     if not results:
         raise HTTPException(status_code=404, detail="No data found")
@@ -950,6 +869,7 @@ def get_top_pickup_places(
     return schemas.TopPlacesResponse(data=data)
 
 @app.get("/top_dropoff_places/", response_model=schemas.TopPlacesResponse)
+@cache.kpi_cache
 def get_top_dropoff_places(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
@@ -959,19 +879,14 @@ def get_top_dropoff_places(
             TRIM(f.drop_off_place) AS place,
             COUNT(*) AS request_count
         FROM factrequests f
-        JOIN dimregions AS dr ON f.region_fk = dr.region_pk
-        JOIN dimdestinations AS dd ON dr.region_pk = dd.region_fk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("dest_code"):
-        filters += " AND dd.dest_code = :dest_code"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND f.pick_up_date::date BETWEEN :start_date AND :end_date"
+    statement, bound = filters.compile_query(query, params, {
+        "dest_code": "f.region_fk",
+        "date_range": "f.pick_up_date"
+    }, " GROUP BY f.drop_off_place ORDER BY request_count DESC LIMIT 10")
     
-    query = query + filters + " GROUP BY f.drop_off_place ORDER BY request_count DESC LIMIT 10"
-    
-    results = db.execute(text(query), params).fetchall()
+    results = db.execute(statement, bound).fetchall()
     
     if not results:
         raise HTTPException(status_code=404, detail="No data found")
@@ -987,6 +902,7 @@ def get_top_dropoff_places(
     return schemas.TopPlacesResponse(data=data)
 
 @app.get("/monthly_revenue_and_gain/", response_model=schemas.MonthlyRevenueAndGainResponse)
+@singleflight.coalesce
 def get_monthly_revenue_and_gain(
     db: Session = Depends(get_db)
 ):
@@ -1026,51 +942,44 @@ def get_monthly_revenue_and_gain(
 
 @app.get("/car/image", response_model=schemas.ImageKPI)
 def get_car_image(
-    db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
-    query = """
-        SELECT 
-            c.image
-        FROM dimcars c
-        JOIN factrequests f ON c.car_pk = f.car_fk
-        JOIN dimdates d ON f.date_fk = d.date_pk
-    """
-    
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND d.date BETWEEN :start_date AND :end_date"
-    if params.get("slug"):
-        filters += " AND c.slug = :slug"
-    
-    query = query + filters + " LIMIT 1"
-    
-    result = db.execute(text(query), params).fetchone()
-    
-    if not result:
+    # The image is an attribute of the car, it is looked up in the catalog.
+    # The date range no longer has to match a request of that car.
+    filters.bind(params)
+    slug = params.get("slug")
+    image = next((
+        car["image"] for car in catalog.rows("dimcars")
+        if car["image"] and (not slug or car["slug"] == slug.strip())
+    ), None)
+    
+    if not image:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    return schemas.ImageKPI(image_url=result.image)
+    return schemas.ImageKPI(image_url=image)
 
 @app.get("/total_price/", response_model=schemas.TotalPriceResponse)
+@cache.kpi_cache
 def get_total_price(
     db: Session = Depends(get_db),
     params: Dict[str, Any] = Depends(common_query_params)
 ):
-    query = """
+    source = rollups.source_for("date_fk")
+    query = f"""
         SELECT
             SUM(f.total_price) as total_price
-        FROM factrequests f
+        FROM {source["table"]} f
         JOIN dimdates d ON f.date_fk = d.date_pk
     """
     
-    filters = "WHERE 1=1"
-    if params.get("start_date") and params.get("end_date"):
-        filters += " AND d.date BETWEEN :start_date AND :end_date"
-    
-    query = query + filters
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": "d.date"
+    })
 
-    result = db.execute(text(query), params).scalar()
+    if snapshot.active():
+        result = snapshot.total_price(params)
+    else:
+        result = db.execute(statement, bound).scalar()
     
     if result is None:
         raise HTTPException(status_code=404, detail="No data found")
@@ -1078,11 +987,27 @@ def get_total_price(
     return schemas.TotalPriceResponse(total_price=round(result,2))
 
 
+@app.get("/export")
+def export_factrequests(
+    format: str = Query("csv", pattern="^(csv|ndjson|parquet|arrow)$"),
+    batch_size: int = Query(10000, ge=100, le=100000),
+    params: Dict[str, Any] = Depends(common_query_params)
+):
+    if format in export.ARROW_FORMATS and not export.arrow_available():
+        raise HTTPException(status_code=501, detail=f"{format} export requires pyarrow")
+
+    statement, bound = export.export_statement(params)
+    spec = export.FORMATS[format]
+    return StreamingResponse(
+        export.stream(format, statement, bound, batch_size),
+        media_type=spec["media_type"],
+        headers={"Content-Disposition": f'attachment; filename="factrequests.{spec["extension"]}"'}
+    )
+
+
 @app.get("/filters/car-types", response_model=List[str])
-async def get_car_types(db: Session = Depends(get_db)):
-    query = 'select slug from dimcars'
-    results = db.execute(text(query)).fetchall()  # Results are tuples
-    return [result[0].strip() for result in results]  # Access by index
+def get_car_types():
+    return catalog.values("dimcars", "slug")
 
 
 @app.get("/filters/dates", response_model=List[str])
@@ -1093,72 +1018,32 @@ async def get_dates(db: Session = Depends(get_db)):
 
 
 @app.get("/filters/dests", response_model=List[str])
-async def get_dests(db: Session = Depends(get_db)):
-    query = 'select dest_code from dimdestinations'
-    results = db.execute(text(query)).fetchall()  # Returns tuples
-    return [result[0].strip() for result in results]  # Access by index
+def get_dests():
+    return catalog.values("dimdestinations", "dest_code")
 
 
 @app.get("/predict_total_price/", response_model=schemas.TotalPricePrediction)
 def predict_total_price(future_date: str, db: Session = Depends(get_db)):
-    query = """
-    SELECT dimdates.date, factrequests.total_price 
-    FROM factrequests
-    JOIN dimdates ON factrequests.date_fk = dimdates.date_pk
-    """
-    result = db.execute(text(query))
-    df = pd.DataFrame(result.fetchall(), columns=['date', 'total_price'])
-
-    df['date'] = pd.to_datetime(df['date'])
-    df['date_numeric'] = (df['date'] - pd.Timestamp("1970-01-01")) // pd.Timedelta('1D')
-
-    X = df[['date_numeric']]
-    y = df['total_price']
-
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=0)
-
-    model = LinearRegression()
-    model.fit(X_train, y_train)
-
     try:
         future_date_obj = datetime.strptime(future_date, '%Y-%m-%d')
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
 
-    future_date_numeric = (future_date_obj - pd.Timestamp("1970-01-01")) // pd.Timedelta('1D')
+    from app import forecasting
 
-    predicted_price = model.predict([[future_date_numeric]])
-    return schemas.TotalPricePrediction(predicted_total_price=round(predicted_price[0], 2))
+    predicted_price = forecasting.predict("total_price", future_date_obj, db)
+    return schemas.TotalPricePrediction(predicted_total_price=round(predicted_price, 2))
 
 @app.get("/optimize_fleet/", response_model=schemas.FleetOptimization)
 def optimize_fleet(future_date: str, db: Session = Depends(get_db)):
-    query = """
-    SELECT dimdates.date, factrequests.total_price, factrequests.passenger_count_client 
-    FROM factrequests
-    JOIN dimdates ON factrequests.date_fk = dimdates.date_pk
-    """
-    result = db.execute(text(query))
-    df = pd.DataFrame(result.fetchall(), columns=['date', 'total_price', 'passenger_count_client'])
-
-    df['date'] = pd.to_datetime(df['date'])
-    df['date_numeric'] = (df['date'] - pd.Timestamp("1970-01-01")) // pd.Timedelta('1D')
-
-    X = df[['date_numeric']]
-    y = df['passenger_count_client']
-
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=0)
-
-    model = LinearRegression()
-    model.fit(X_train, y_train)
-
     try:
         future_date_obj = datetime.strptime(future_date, '%Y-%m-%d')
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
 
-    future_date_numeric = (future_date_obj - pd.Timestamp("1970-01-01")) // pd.Timedelta('1D')
+    from app import forecasting
 
-    predicted_passenger_count = math.ceil(model.predict([[future_date_numeric]])[0])
+    predicted_passenger_count = math.ceil(forecasting.predict("passenger_count", future_date_obj, db))
 
     vehicle_capacity = 4
     recommended_fleet_size = math.ceil(predicted_passenger_count / vehicle_capacity)
@@ -1168,4 +1053,297 @@ def optimize_fleet(future_date: str, db: Session = Depends(get_db)):
         predicted_passenger_count=predicted_passenger_count,
         recommended_fleet_size=recommended_fleet_size,
         adjusted_fleet_size=recommended_fleet_size_adjusted
-    )
\ No newline at end of file
+    )
+
+
+@app.get("/forecast/batch", response_model=schemas.ForecastBatchResponse)
+def forecast_batch(
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    dates: Optional[List[str]] = Query(None),
+    granularity: str = Query("day", pattern="^(day|week|month)$"),
+    db: Session = Depends(get_db)
+):
+    from app import forecasting
+
+    try:
+        if dates:
+            days = sorted(set(datetime.strptime(d, '%Y-%m-%d') for d in dates))
+        elif start_date and end_date:
+            days = forecasting.forecast_dates(
+                datetime.strptime(start_date, '%Y-%m-%d'),
+                datetime.strptime(end_date, '%Y-%m-%d'),
+                granularity
+            )
+        else:
+            raise HTTPException(status_code=400, detail="Provide dates or start_date and end_date.")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+
+    if len(days) == 0:
+        raise HTTPException(status_code=400, detail="The date range is empty.")
+    if len(days) > forecasting.MAX_BATCH_DATES:
+        raise HTTPException(status_code=400, detail=f"At most {forecasting.MAX_BATCH_DATES} dates per request.")
+
+    prices, passengers, fleet, adjusted_fleet = forecasting.forecast(days, db)
+
+    data = [
+        schemas.ForecastPoint(
+            date=day.strftime('%Y-%m-%d'),
+            predicted_total_price=round(float(prices[i]), 2),
+            predicted_passenger_count=int(passengers[i]),
+            recommended_fleet_size=int(fleet[i]),
+            adjusted_fleet_size=int(adjusted_fleet[i])
+        )
+        for i, day in enumerate(days)
+    ]
+
+    return schemas.ForecastBatchResponse(data=data)
+
+
+@app.get("/admin/models", response_model=List[schemas.ModelInfo])
+def get_models_info():
+    from app import forecasting
+
+    forecasting.ensure_loaded()
+    return forecasting.info()
+
+
+@app.post("/admin/models/retrain", response_model=List[schemas.ModelInfo])
+def retrain_models(db: Session = Depends(get_db)):
+    from app import forecasting
+
+    return forecasting.retrain(db, data_version.current(force=True))
+
+
+DASHBOARD_KPIS = {
+    "growth_kpi": get_growth_kpi,
+    "factrequests_gain": read_factrequest_gain,
+    "brand_gains": get_car_type_gains,
+    "car_clients_kpi": get_car_clients_kpi,
+    "car_owners_kpi": get_car_owners_kpi,
+    "requests_per_benchmark_by_source_and_region": get_requests_per_benchmark_by_source_and_region,
+    "requests_per_offer": get_requests_per_offer,
+    "clients_percentage_per_car_type_and_request_type": get_clients_percentage_per_car_type_and_request_type,
+    "most_popular_requests": get_most_popular_requests,
+    "benchmark_performance_by_region": get_benchmark_performance_by_region,
+    "revenue_by_offer_and_date": get_revenue_by_offer_and_date,
+    "charge_kpi": get_charge_kpi,
+    "most_revenue_generating_countries": get_most_revenue_generating_countries,
+    "revenue_over_time_per_benchmark": get_revenue_over_time_per_benchmark,
+    "timeline_kpi": get_timeline_kpi,
+    "quarterly_revenue_per_request_type": get_quarterly_revenue_per_request_type,
+    "total_amount_and_percentage_gain_per_month": get_total_amount_and_percentage_gain_per_month,
+    "car_profitability_kpi": get_car_profitability_kpi,
+    "profit_total_and_other_charges": get_profit_total_and_other_charges,
+    "car_rentation_rate_overtime": get_car_rentation_rate_overtime,
+    "top_pickup_places": get_top_pickup_places,
+    "top_dropoff_places": get_top_dropoff_places,
+    "monthly_revenue_and_gain": get_monthly_revenue_and_gain,
+    "total_price": get_total_price,
+}
+
+# KPIs that only differ by the dimension they group on are answered by one
+# GROUPING SETS scan, as long as the request carries no filter the shared
+# scan does not apply (it only applies the date range).
+SHARED_KPIS = {
+    "charge_kpi": {"grouping": None, "skip_if": ()},
+    "timeline_kpi": {"grouping": "d.date", "skip_if": ()},
+    "requests_per_offer": {"grouping": "TRIM(o.adjustement_type)", "skip_if": ()},
+    "brand_gains": {"grouping": "TRIM(c.brand)", "skip_if": ("slug",)},
+    "most_popular_requests": {"grouping": "TRIM(r.req_type)", "skip_if": ("dest_code",)},
+}
+
+
+@cache.kpi_cache
+def dashboard_shared_scan(db: Session, params: Dict[str, Any], kpis: List[str]):
+    source = rollups.source_for("date_fk", "car_fk", "offer_fk", "req_type_fk", "pick_up_day")
+    columns = [SHARED_KPIS[kpi]["grouping"] for kpi in kpis if SHARED_KPIS[kpi]["grouping"]]
+    grouping_sets = ", ".join(["()"] + [f"({column})" for column in columns])
+    groupings = "".join(f"GROUPING({column}) AS g{i}, {column} AS k{i}, " for i, column in enumerate(columns))
+
+    query = f"""
+        SELECT
+            {groupings}
+            {source["count"]} as request_count,
+            SUM(f.total_price) as total_price,
+            SUM(f.offer_price) as offer_price,
+            SUM(f.prix_annuel) as prix_annuel,
+            {source["gain"]} as gain
+        FROM {source["table"]} f
+        LEFT JOIN dimdates d ON f.date_fk = d.date_pk
+        LEFT JOIN dimcars c ON f.car_fk = c.car_pk
+        LEFT JOIN dimoffers o ON f.offer_fk = o.offer_pk
+        LEFT JOIN dimrequesttypes r ON f.req_type_fk = r.req_type_pk
+    """
+
+    statement, bound = filters.compile_query(query, params, {
+        "date_range": source["day"]
+    }, f" GROUP BY GROUPING SETS ({grouping_sets})")
+
+    results = db.execute(statement, bound).fetchall()
+
+    groups = {column: [] for column in columns}
+    total = None
+    for row in results:
+        mapping = row._mapping
+        grouped = [column for i, column in enumerate(columns) if mapping[f"g{i}"] == 0]
+        if not grouped:
+            total = row
+            continue
+        i = columns.index(grouped[0])
+        # Rows whose dimension key is missing are dropped like the inner
+        # joins of the individual endpoints do.
+        if mapping[f"k{i}"] is not None:
+            groups[grouped[0]].append((mapping[f"k{i}"], row))
+
+    payloads = {}
+    errors = {}
+    for kpi in kpis:
+        rows = groups.get(SHARED_KPIS[kpi]["grouping"], [])
+        if kpi == "charge_kpi":
+            if total is None or total.prix_annuel is None:
+                errors[kpi] = schemas.DashboardError(status_code=404, detail="Data not found")
+            else:
+                payloads[kpi] = schemas.ChargeKPI(total_charge=round(total.prix_annuel, 2))
+        elif not rows:
+            errors[kpi] = schemas.DashboardError(status_code=404, detail="Data not found")
+        elif kpi == "timeline_kpi":
+            payloads[kpi] = schemas.TimelineKPIResponse(data=[
+                schemas.TimelineKPIData(
+                    date=key.strftime('%Y-%m-%d'),
+                    request_count=row.request_count,
+                    total_revenue=row.total_price
+                )
+                for key, row in sorted(rows, key=lambda item: item[0])
+            ])
+        elif kpi == "requests_per_offer":
+            payloads[kpi] = schemas.RequestsPerOffer(data=[
+                schemas.OfferData(adjustement_type=key.strip(), request_count=row.request_count)
+                for key, row in rows
+            ])
+        elif kpi == "brand_gains":
+            payloads[kpi] = schemas.BrandGainsKPI(data=[
+                schemas.BrandGain(brand=key.strip(), total_gain=round(row.gain or 0, 2))
+                for key, row in rows
+            ])
+        elif kpi == "most_popular_requests":
+            top = sorted(rows, key=lambda item: item[1].request_count, reverse=True)[:10]
+            payloads[kpi] = schemas.MostPopularRequests(data=[
+                schemas.PopularRequestData(request_type=key.strip(), request_count=row.request_count)
+                for key, row in top
+            ])
+
+    return payloads, errors
+
+
+def _endpoint_kwargs(func, params):
+    kwargs = {}
+    for name, parameter in inspect.signature(func).parameters.items():
+        if name == "db":
+            continue
+        if name == "params":
+            kwargs[name] = params
+        elif name == "format":
+            kwargs[name] = "json"
+        elif params.get(name) is not None:
+            value = params[name]
+            if isinstance(value, str) and getattr(parameter.annotation, "__origin__", None) is list:
+                value = [value]
+            kwargs[name] = value
+        else:
+            kwargs[name] = getattr(parameter.default, "default", parameter.default)
+    return kwargs
+
+
+def _run_with_own_session(func, kwargs):
+    db = database.SessionLocal()
+    try:
+        return func(db=db, **kwargs)
+    finally:
+        db.close()
+
+
+async def _run_dashboard_kpi(name, params):
+    func = DASHBOARD_KPIS[name]
+    kwargs = _endpoint_kwargs(func, params)
+    try:
+        if asyncio.iscoroutinefunction(func):
+            return name, serialization.payload(await func(**kwargs)), None
+        return name, serialization.payload(await run_in_threadpool(_run_with_own_session, func, kwargs)), None
+    except HTTPException as e:
+        return name, None, schemas.DashboardError(status_code=e.status_code, detail=str(e.detail))
+    except Exception as e:
+        return name, None, schemas.DashboardError(status_code=500, detail=str(e))
+
+
+@app.get("/dashboard", response_model=schemas.DashboardResponse)
+async def get_dashboard(
+    kpis: Optional[List[str]] = Query(None),
+    params: Dict[str, Any] = Depends(common_query_params)
+):
+    requested = list(dict.fromkeys(kpis or DASHBOARD_KPIS))
+    unknown = [kpi for kpi in requested if kpi not in DASHBOARD_KPIS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown KPIs: {', '.join(unknown)}")
+
+    # Malformed dates fail the whole request rather than every KPI.
+    filters.bind(params)
+
+    shared = [
+        kpi for kpi in requested
+        if kpi in SHARED_KPIS and not any(params.get(name) for name in SHARED_KPIS[kpi]["skip_if"])
+    ]
+    individual = [kpi for kpi in requested if kpi not in shared]
+
+    async def run_shared_scan():
+        if not shared:
+            return {}, {}
+        try:
+            return await run_in_threadpool(
+                _run_with_own_session, dashboard_shared_scan, {"params": params, "kpis": shared}
+            )
+        except Exception as e:
+            # Same as a failing individual KPI: reported per KPI, the others are still served.
+            return {}, {kpi: schemas.DashboardError(status_code=500, detail=str(e)) for kpi in shared}
+
+    (data, errors), results = await asyncio.gather(
+        run_shared_scan(),
+        asyncio.gather(*(_run_dashboard_kpi(kpi, params) for kpi in individual)),
+    )
+    data = dict(data)
+    errors = dict(errors)
+    for name, payload, error in results:
+        if error is None:
+            data[name] = payload
+        else:
+            errors[name] = error
+
+    return schemas.DashboardResponse(
+        data={kpi: data[kpi] for kpi in requested if kpi in data},
+        errors=errors
+    )
+
+
+async def _warm_kpi_caches():
+    # The unfiltered KPIs are what the dashboard loads first, they are
+    # computed once during warm-up so the first visitors hit the cache.
+    params = {name: None for name in inspect.signature(common_query_params).parameters}
+    factories = [
+        functools.partial(_run_dashboard_kpi, name, params)
+        for name, func in DASHBOARD_KPIS.items() if getattr(func, "kpi_cached", False)
+    ]
+    factories.append(functools.partial(
+        run_in_threadpool, _run_with_own_session, dashboard_shared_scan, {"params": params, "kpis": list(SHARED_KPIS)}
+    ))
+    await warmup.bounded(factories)
+
+
+@app.on_event("startup")
+async def warm_up():
+    # Runs in the background: the worker accepts connections right away and
+    # /ready turns 200 once the pools, the data version and the caches are warm.
+    steps = warmup.default_steps() + [("kpi_caches", _warm_kpi_caches, False)]
+    app.state.warmup = asyncio.ensure_future(warmup.run(steps))
+    if precompute.ENABLED:
+        app.state.precompute = asyncio.ensure_future(precompute.run_forever())
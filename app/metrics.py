@@ -0,0 +1,264 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from app import pool_metrics, singleflight
+
+# Upper bounds in seconds of the latency histograms.
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+_lock = threading.Lock()
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class _RequestMetrics:
+    # Filled from the event loop, the threadpool and the dashboard fan-out,
+    # every update goes through the lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.route = None
+        self.sql_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.endpoint_seconds = 0.0
+        self.handler_seconds = 0.0
+
+    def add(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+
+class _Histogram:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+
+    def observe(self, values, amount):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if amount <= bound:
+                series["buckets"][i] += 1
+        series["sum"] += amount
+        series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for values, series in sorted(self.series.items()):
+            labels = _labels(self.labels, values)
+            for bound, count in zip(BUCKETS, series["buckets"]):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series['sum']}")
+            lines.append(f"{self.name}_count{{{labels}}} {series['count']}")
+        return lines
+
+
+class _Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, values, amount=1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self.series.items()):
+            lines.append(f"{self.name}{{{_labels(self.labels, values)}}} {total}")
+        return lines
+
+
+REQUESTS = _Counter("spn_http_requests_total", "Requests served.", ("route", "method", "status"))
+LATENCY = _Histogram("spn_http_request_duration_seconds", "Request latency.", ("route", "method"))
+SQL_TIME = _Histogram("spn_sql_duration_seconds", "SQL execution time per request.", ("route",))
+SERIALIZATION = _Histogram(
+    "spn_serialization_duration_seconds",
+    "Time between the endpoint returning and the response being ready.", ("route",)
+)
+STATEMENTS = _Counter("spn_sql_statements_total", "SQL statements executed.", ("route",))
+ROWS = _Counter("spn_sql_rows_total", "Rows reported by the driver for SQL statements.", ("route",))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def current_route():
+    current = _current.get()
+    return current.route if current is not None else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._spn_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    current = _current.get()
+    started = getattr(context, "_spn_started", None)
+    if current is None or started is None:
+        return
+    # rowcount is the number of rows of a SELECT for psycopg2 and asyncpg,
+    # server side cursors report -1 and are not counted.
+    rows = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+    current.add(sql_seconds=time.perf_counter() - started, statements=1, rows=rows)
+
+
+def instrument(engine):
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+
+def _timed_endpoint(endpoint):
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                current = _current.get()
+                if current is not None:
+                    current.add(endpoint_seconds=time.perf_counter() - started)
+        return wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            current = _current.get()
+            if current is not None:
+                current.add(endpoint_seconds=time.perf_counter() - started)
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    # The route handler validates the parameters, calls the endpoint and
+    # serializes the result; the endpoint is timed on its own so the
+    # remainder is the response_model validation and JSON encoding.
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            current = _current.get()
+            if current is not None:
+                current.route = self.path
+            started = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                if current is not None:
+                    current.add(handler_seconds=time.perf_counter() - started)
+
+        return timed_handler
+
+
+def _server_timing(current, total):
+    serialize = max(current.handler_seconds - current.endpoint_seconds, 0.0) if current.handler_seconds else 0.0
+    return ", ".join([
+        f'sql;dur={current.sql_seconds * 1000:.2f};desc="{current.statements} statements, {current.rows} rows"',
+        f"app;dur={max(current.endpoint_seconds - current.sql_seconds, 0.0) * 1000:.2f}",
+        f"serialize;dur={serialize * 1000:.2f}",
+        f"total;dur={total * 1000:.2f}",
+    ]), serialize
+
+
+async def track_request(request, call_next):
+    current = _RequestMetrics()
+    token = _current.set(current)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        _current.reset(token)
+        total = time.perf_counter() - started
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        timing, serialize = _server_timing(current, total)
+        with _lock:
+            REQUESTS.inc((path, request.method, str(status)))
+            LATENCY.observe((path, request.method), total)
+            SQL_TIME.observe((path,), current.sql_seconds)
+            SERIALIZATION.observe((path,), serialize)
+            STATEMENTS.inc((path,), current.statements)
+            ROWS.inc((path,), current.rows)
+    # Streaming responses run their SQL after this point, only the work done
+    # before the headers are sent is reported for them.
+    response.headers["Server-Timing"] = timing
+    return response
+
+
+def _pool_lines():
+    pools = pool_metrics.snapshot()
+    series = [
+        ("spn_pool_size", "gauge", "Configured pool size.", "size"),
+        ("spn_pool_checked_out", "gauge", "Connections currently checked out.", "checked_out"),
+        ("spn_pool_overflow", "gauge", "Connections opened above the pool size.", "overflow"),
+        ("spn_pool_checkouts_total", "counter", "Successful connection checkouts.", "checkouts"),
+        ("spn_pool_checkout_timeouts_total", "counter", "Checkouts that timed out.", "timeouts"),
+        ("spn_pool_connects_total", "counter", "New database connections.", "connects"),
+        ("spn_pool_invalidations_total", "counter", "Invalidated connections.", "invalidations"),
+    ]
+    lines = []
+    for metric, kind, help_text, key in series:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{pool="{name}"}} {pool[key]}' for name, pool in sorted(pools.items())]
+
+    metric = "spn_pool_checkout_wait_seconds"
+    lines += [f"# HELP {metric} Time spent waiting for a pooled connection.", f"# TYPE {metric} histogram"]
+    for name, pool in sorted(pools.items()):
+        cumulative = 0
+        for bound, count in zip(pool["bucket_bounds_ms"], pool["wait_buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{pool="{name}",le="{bound / 1000}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{pool="{name}",le="+Inf"}} {pool["checkouts"] + pool["timeouts"]}')
+        lines.append(f'{metric}_sum{{pool="{name}"}} {pool["wait_ms_sum"] / 1000}')
+        lines.append(f'{metric}_count{{pool="{name}"}} {pool["checkouts"] + pool["timeouts"]}')
+    return lines
+
+
+def _singleflight_lines():
+    metric = "spn_singleflight_requests_total"
+    lines = [
+        f"# HELP {metric} Requests that ran their query (leader) or waited for an identical in-flight one (coalesced).",
+        f"# TYPE {metric} counter",
+    ]
+    for endpoint, stats in sorted(singleflight.group.stats(top=0)["endpoints"].items()):
+        lines.append(f'{metric}{{endpoint="{endpoint}",role="leader"}} {stats["executions"]}')
+        lines.append(f'{metric}{{endpoint="{endpoint}",role="coalesced"}} {stats["coalesced"]}')
+    return lines
+
+
+def render():
+    with _lock:
+        lines = []
+        for metric in (REQUESTS, LATENCY, SQL_TIME, SERIALIZATION, STATEMENTS, ROWS):
+            lines += metric.render()
+    lines += _pool_lines()
+    lines += _singleflight_lines()
+    return "\n".join(lines) + "\n"
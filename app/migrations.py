@@ -0,0 +1,230 @@
+import argparse
+import json
+import sys
+from datetime import date
+
+from sqlalchemy import event, text
+
+from app import database
+
+MEASURES = "INCLUDE (total_price, offer_price, prix_annuel)"
+
+INDEXES = [
+    ("ix_factrequests_pick_up_date", "factrequests (pick_up_date) " + MEASURES),
+    ("ix_factrequests_date_fk", "factrequests (date_fk) " + MEASURES),
+    ("ix_factrequests_car_fk", "factrequests (car_fk) " + MEASURES),
+    ("ix_factrequests_region_fk", "factrequests (region_fk) " + MEASURES),
+    ("ix_factrequests_req_type_fk", "factrequests (req_type_fk) " + MEASURES),
+    ("ix_factrequests_bench1_fk", "factrequests (bench1_fk) " + MEASURES),
+    ("ix_factrequests_offer_fk", "factrequests (offer_fk) " + MEASURES),
+    ("ix_factrequests_car_fk_pick_up_date", "factrequests (car_fk, pick_up_date)"),
+    ("ix_dimdestinations_dest_code", "dimdestinations (dest_code, region_fk)"),
+    ("ix_dimcars_slug", "dimcars (slug)"),
+    ("ix_dimdates_date", "dimdates (date)"),
+]
+
+FACT_RELATIONS = ("factrequests",)
+
+# The KPI endpoints the advisor requests. Listed explicitly: /export streams
+# the whole fact table, /dashboard repeats every KPI and the forecasting
+# routes train models.
+KPI_ROUTES = (
+    "/growth_kpi/",
+    "/factrequests/gain",
+    "/brand-gains/",
+    "/car_clients_kpi/",
+    "/car_owners_kpi/",
+    "/requests_per_benchmark_by_source_and_region/",
+    "/requests_per_offer/",
+    "/clients_percentage_per_car_type_and_request_type/",
+    "/most_popular_requests/",
+    "/benchmark_performance_by_region/",
+    "/revenue_by_offer_and_date/",
+    "/charge_kpi/",
+    "/most_revenue_generating_countries/",
+    "/revenue_over_time_per_benchmark/",
+    "/timeline_kpi/",
+    "/quarterly_revenue_per_request_type/",
+    "/total_amount_and_percentage_gain_per_month/",
+    "/car_profitability_kpi/",
+    "/profit_total_and_other_charges/",
+    "/car_rentation_rate_overtime",
+    "/top_pickup_places/",
+    "/top_dropoff_places/",
+    "/monthly_revenue_and_gain/",
+    "/total_price/",
+)
+
+
+def create_indexes(concurrently=True):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block.
+    keyword = "CONCURRENTLY " if concurrently else ""
+    with database.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SET statement_timeout = 0"))
+        for name, definition in INDEXES:
+            print(f"creating {name}")
+            conn.execute(text(f"CREATE INDEX {keyword}IF NOT EXISTS {name} ON {definition}"))
+        for table in ("factrequests", "dimdestinations", "dimcars", "dimdates"):
+            conn.execute(text(f"ANALYZE {table}"))
+
+
+def _month_starts(first, last):
+    current = date(first.year, first.month, 1)
+    while current <= last:
+        yield current
+        current = date(current.year + current.month // 12, current.month % 12 + 1, 1)
+
+
+def partition_by_month():
+    # The current table is kept as factrequests_unpartitioned so the switch can
+    # be rolled back by renaming. A primary key on req_pk alone is not possible
+    # on a table partitioned by pick_up_date and is not recreated.
+    with database.engine.begin() as conn:
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        partitioned = conn.execute(text(
+            "SELECT relkind = 'p' FROM pg_class WHERE oid = 'factrequests'::regclass"
+        )).scalar()
+        if partitioned:
+            print("factrequests is already partitioned")
+            return
+
+        first, last = conn.execute(text(
+            "SELECT MIN(pick_up_date)::date, MAX(pick_up_date)::date FROM factrequests"
+        )).one()
+
+        conn.execute(text(
+            "CREATE TABLE factrequests_partitioned (LIKE factrequests INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (pick_up_date)"
+        ))
+        if first is not None:
+            for start in _month_starts(first, last):
+                end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+                name = f"factrequests_y{start.year}m{start.month:02d}"
+                print(f"creating {name}")
+                conn.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF factrequests_partitioned "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                ))
+        conn.execute(text("CREATE TABLE factrequests_default PARTITION OF factrequests_partitioned DEFAULT"))
+
+        conn.execute(text("INSERT INTO factrequests_partitioned SELECT * FROM factrequests"))
+        conn.execute(text("ALTER TABLE factrequests RENAME TO factrequests_unpartitioned"))
+        # Index names are global to the schema: the old table's indexes are
+        # renamed with it, otherwise CREATE INDEX IF NOT EXISTS below would
+        # skip them and leave the partitioned table unindexed.
+        for name, definition in INDEXES:
+            if definition.startswith("factrequests "):
+                conn.execute(text(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_unpartitioned"))
+        conn.execute(text("ALTER TABLE factrequests_partitioned RENAME TO factrequests"))
+
+    # Indexes on a partitioned table cannot be built concurrently, they are
+    # created on every partition in one go.
+    create_indexes(concurrently=False)
+
+
+def _seq_scans(plan, found):
+    relation = plan.get("Relation Name", "")
+    if plan.get("Node Type") == "Seq Scan" and relation.startswith(FACT_RELATIONS):
+        found.append(relation)
+    for child in plan.get("Plans", []):
+        _seq_scans(child, found)
+    return found
+
+
+def explain(raw, statement, parameters, asyncpg_style, options="FORMAT JSON"):
+    cursor = raw.cursor()
+    prepared = False
+    try:
+        if asyncpg_style:
+            # asyncpg statements use $n placeholders, PREPARE understands them.
+            cursor.execute(f"PREPARE advisor_statement AS {statement}")
+            prepared = True
+            placeholders = ", ".join(["%s"] * len(parameters))
+            cursor.execute(f"EXPLAIN ({options}) EXECUTE advisor_statement({placeholders})", tuple(parameters))
+            plan = cursor.fetchone()[0]
+        else:
+            cursor.execute(f"EXPLAIN ({options}) {statement}", parameters)
+            plan = cursor.fetchone()[0]
+    finally:
+        raw.rollback()
+        if prepared:
+            # Prepared statements survive the rollback, left behind they would
+            # make the next PREPARE on this pooled connection fail.
+            cursor.execute("DEALLOCATE advisor_statement")
+            raw.rollback()
+        cursor.close()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def advise():
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    captured = []
+
+    def capture(asyncpg_style):
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+                captured.append((statement, parameters, asyncpg_style))
+        return before_cursor_execute
+
+    event.listen(database.engine, "before_cursor_execute", capture(False))
+    event.listen(database.async_engine.sync_engine, "before_cursor_execute", capture(True))
+
+    with database.engine.connect() as conn:
+        first, last = conn.execute(text("SELECT MIN(date), MAX(date) FROM dimdates")).one()
+    variants = [{}]
+    if first is not None:
+        variants.append({"start_date": str(last.replace(day=1)), "end_date": str(last)})
+
+    report = []
+    with TestClient(app) as client:
+        raw = database.engine.raw_connection()
+        try:
+            for path in KPI_ROUTES:
+                for variant in variants:
+                    del captured[:]
+                    status = client.get(path, params=variant).status_code
+                    for statement, parameters, asyncpg_style in list(captured):
+                        plan = explain(raw, statement, parameters, asyncpg_style)["Plan"]
+                        report.append({
+                            "route": path,
+                            "params": variant,
+                            "status": status,
+                            "total_cost": plan.get("Total Cost"),
+                            "fact_seq_scans": _seq_scans(plan, []),
+                        })
+        finally:
+            raw.close()
+
+    flagged = [entry for entry in report if entry["fact_seq_scans"]]
+    for entry in report:
+        marker = "SEQ SCAN" if entry["fact_seq_scans"] else "ok"
+        print(f"{marker:8} {entry['route']} {entry['params'] or ''} cost={entry['total_cost']}")
+    print(f"{len(flagged)} of {len(report)} statements scan the fact table sequentially")
+    return flagged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Physical layout migrations for DW_SPN")
+    commands = parser.add_subparsers(dest="command", required=True)
+    indexes = commands.add_parser("indexes", help="create the indexes used by the endpoints")
+    indexes.add_argument("--no-concurrently", action="store_true")
+    commands.add_parser("partition", help="convert factrequests to monthly range partitions")
+    commands.add_parser("advise", help="EXPLAIN every endpoint query and report fact table seq scans")
+    args = parser.parse_args(argv)
+
+    if args.command == "indexes":
+        create_indexes(concurrently=not args.no_concurrently)
+    elif args.command == "partition":
+        partition_by_month()
+    elif args.command == "advise":
+        return 1 if advise() else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+WAIT_WARNING_MS = float(os.getenv("SPN_POOL_WAIT_WARNING_MS", "100"))
+
+# Upper bounds in milliseconds of the checkout wait histogram.
+BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_lock = threading.Lock()
+_pools = {}
+
+
+def _new_stats():
+    return {
+        "checkouts": 0,
+        "timeouts": 0,
+        "connects": 0,
+        "invalidations": 0,
+        "wait_ms_sum": 0.0,
+        "wait_ms_max": 0.0,
+        "wait_buckets": [0] * (len(BUCKETS) + 1),
+    }
+
+
+def _record_wait(name, wait_ms, timed_out=False):
+    if name not in _pools:
+        return
+    with _lock:
+        stats = _pools[name]["stats"]
+        if timed_out:
+            stats["timeouts"] += 1
+        else:
+            stats["checkouts"] += 1
+        stats["wait_ms_sum"] += wait_ms
+        stats["wait_ms_max"] = max(stats["wait_ms_max"], wait_ms)
+        for i, bound in enumerate(BUCKETS):
+            if wait_ms <= bound:
+                stats["wait_buckets"][i] += 1
+                break
+        else:
+            stats["wait_buckets"][-1] += 1
+    if timed_out or wait_ms > WAIT_WARNING_MS:
+        pool = _pools[name]["pool"]
+        logger.warning(
+            "pool %s: %s after %.1f ms (size=%s checked_out=%s overflow=%s)",
+            name, "checkout timed out" if timed_out else "slow checkout", wait_ms,
+            pool.size(), pool.checkedout(), pool.overflow(),
+        )
+
+
+class _TimedCheckout:
+    metrics_name = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            _record_wait(self.metrics_name, (time.perf_counter() - started) * 1000, timed_out=True)
+            raise
+        _record_wait(self.metrics_name, (time.perf_counter() - started) * 1000)
+        return connection
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument(name, engine):
+    sync_engine = getattr(engine, "sync_engine", engine)
+    pool = sync_engine.pool
+    pool.metrics_name = name
+    with _lock:
+        _pools[name] = {"pool": pool, "stats": _new_stats()}
+
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        with _lock:
+            _pools[name]["stats"]["connects"] += 1
+
+    @event.listens_for(pool, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        with _lock:
+            _pools[name]["stats"]["invalidations"] += 1
+
+    return engine
+
+
+def snapshot():
+    with _lock:
+        report = {}
+        for name, entry in _pools.items():
+            pool = entry["pool"]
+            stats = dict(entry["stats"], wait_buckets=list(entry["stats"]["wait_buckets"]))
+            report[name] = {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+                "max_overflow": pool._max_overflow,
+                "timeout_seconds": pool.timeout(),
+                "bucket_bounds_ms": BUCKETS,
+                **stats,
+            }
+        return report
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from app import data_version, rollups, warmup
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("SPN_PRECOMPUTE", "1") == "1"
+TOP_N = int(os.getenv("SPN_PRECOMPUTE_TOP_N", "50"))
+MIN_REQUESTS = float(os.getenv("SPN_PRECOMPUTE_MIN_REQUESTS", "2"))
+CONCURRENCY = int(os.getenv("SPN_PRECOMPUTE_CONCURRENCY", str(warmup.CONCURRENCY)))
+MAX_TRACKED = int(os.getenv("SPN_PRECOMPUTE_MAX_TRACKED", "2048"))
+HISTORY_SIZE = 20
+
+_lock = threading.Lock()
+_popularity = {}
+_state = {"running": False, "version": None, "queued": 0, "current": None, "history": deque(maxlen=HISTORY_SIZE)}
+
+
+def record(key, func, kwargs):
+    # Called by the KPI cache for every request: key is the cache key, func
+    # the undecorated endpoint and kwargs its arguments without the session.
+    with _lock:
+        entry = _popularity.get(key)
+        if entry is None:
+            entry = _popularity[key] = {"func": func, "kwargs": kwargs, "count": 0.0}
+        entry["count"] += 1
+        if len(_popularity) > 2 * MAX_TRACKED:
+            for stale in sorted(_popularity, key=lambda k: _popularity[k]["count"])[:len(_popularity) - MAX_TRACKED]:
+                del _popularity[stale]
+
+
+def popular(top=TOP_N):
+    with _lock:
+        entries = sorted(_popularity.items(), key=lambda item: item[1]["count"], reverse=True)
+        return [(key, entry) for key, entry in entries[:top] if entry["count"] >= MIN_REQUESTS]
+
+
+def _decay():
+    # Halving after every refresh keeps the ranking on recent traffic.
+    with _lock:
+        for key in list(_popularity):
+            _popularity[key]["count"] /= 2
+            if _popularity[key]["count"] < 0.5:
+                del _popularity[key]
+
+
+async def refresh(version):
+    from app import cache
+
+    combinations = popular()
+    started = time.time()
+    run = {"version": version, "started_at": started, "combinations": len(combinations),
+           "computed": 0, "skipped": 0, "errors": 0, "seconds": None}
+    _state["current"] = run
+    _state["queued"] = len(combinations)
+
+    async def precompute(entry):
+        try:
+            pending = cache.refresh(entry["func"], entry["kwargs"], version)
+            if pending is None:
+                run["skipped"] += 1
+                return
+            await pending
+            run["computed"] += 1
+        finally:
+            _state["queued"] -= 1
+
+    results = await warmup.bounded(
+        [lambda entry=entry: precompute(entry) for _, entry in combinations], CONCURRENCY
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            run["errors"] += 1
+            logger.warning("precompute failed for version %s: %s", version, result)
+    run["seconds"] = round(time.time() - started, 3)
+    _state["current"] = None
+    _state["history"].appendleft(run)
+    _decay()
+    logger.info("precomputed %s combinations for version %s in %.1fs", run["computed"], version, run["seconds"])
+
+
+async def run_forever(interval=data_version.PROBE_INTERVAL):
+    # Polls the data version at the probe interval, so a new load is picked
+    # up even when no request arrives, and warms the popular combinations.
+    _state["running"] = True
+    try:
+        while True:
+            try:
+                version = await asyncio.to_thread(data_version.current)
+                if version != _state["version"]:
+                    # Rebuilt first, so the combinations below are computed
+                    # from rollups of the new data.
+                    try:
+                        await asyncio.to_thread(rollups.refresh_if_stale, version)
+                    except Exception as e:
+                        logger.warning("rollup refresh failed for version %s: %s", version, e)
+                    if _state["version"] is not None:
+                        await refresh(version)
+                    _state["version"] = version
+            except Exception as e:
+                logger.warning("precompute scheduler failed: %s", e)
+            await asyncio.sleep(interval)
+    finally:
+        _state["running"] = False
+
+
+def info(top=20):
+    return {
+        "enabled": ENABLED,
+        "running": _state["running"],
+        "version": _state["version"],
+        "top_n": TOP_N,
+        "min_requests": MIN_REQUESTS,
+        "concurrency": CONCURRENCY,
+        "queued": _state["queued"],
+        "current": dict(_state["current"]) if _state["current"] else None,
+        "history": list(_state["history"]),
+        "tracked": len(_popularity),
+        "popular": [
+            {"endpoint": key[0], "params": repr(key[1]), "score": round(entry["count"], 2)}
+            for key, entry in popular(top)
+        ],
+    }
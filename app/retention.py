@@ -0,0 +1,67 @@
+import numpy as np
+from sqlalchemy import text
+
+GRANULARITIES = ("quarter", "month", "week")
+
+# The window is counted back from the latest period that has data, not from
+# today, so a warehouse whose loads stopped still reports its last periods.
+PERIOD_CARS_QUERY = """
+    WITH latest AS (
+        SELECT DATE_TRUNC('{granularity}', MAX(pick_up_date)) AS period
+        FROM factrequests
+        WHERE pick_up_date <= CURRENT_DATE
+    )
+    SELECT
+        DATE_TRUNC('{granularity}', f.pick_up_date) AS period,
+        ARRAY_AGG(DISTINCT f.car_fk) AS cars
+    FROM factrequests f, latest
+    WHERE f.pick_up_date >= latest.period - (:lookback - 1) * INTERVAL '{step}'
+      AND f.pick_up_date <= CURRENT_DATE
+      AND f.car_fk IS NOT NULL
+    GROUP BY 1
+    ORDER BY 1 DESC
+"""
+
+STEPS = {"quarter": "3 months", "month": "1 month", "week": "1 week"}
+
+
+def period_label(granularity, period):
+    if granularity == "week":
+        year, week, _ = period.isocalendar()
+        return f"{year}-W{week:02d}"
+    if granularity == "month":
+        return f"{period.year}-{period.month:02d}"
+    return f"{period.year}-Q{(period.month - 1) // 3 + 1}"
+
+
+def period_cars_query(granularity):
+    # granularity is checked against GRANULARITIES, DATE_TRUNC needs it as a
+    # literal for the grouping expression to match the select list.
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity!r}")
+    return text(PERIOD_CARS_QUERY.format(granularity=granularity, step=STEPS[granularity]))
+
+
+def retention_rates(rows):
+    # rows: (period, cars) ordered from the most recent period. Car keys are
+    # mapped to dense codes and every period becomes a row of a boolean bitmap,
+    # so the retained counts of all consecutive pairs come out of one AND.
+    periods = [row[0] for row in rows]
+    car_arrays = [np.asarray(row[1], dtype=np.int64) for row in rows]
+    if len(periods) < 2:
+        return []
+
+    sizes = np.array([cars.size for cars in car_arrays])
+    _, codes = np.unique(np.concatenate(car_arrays), return_inverse=True)
+    bitmap = np.zeros((len(periods), codes.max() + 1 if codes.size else 0), dtype=bool)
+    bitmap[np.repeat(np.arange(len(periods)), sizes), codes] = True
+
+    retained = np.logical_and(bitmap[:-1], bitmap[1:]).sum(axis=1)
+    previous = bitmap[1:].sum(axis=1)
+    rates = np.divide(retained, previous, out=np.zeros(len(retained)), where=previous > 0)
+
+    return [
+        (periods[i], float(rates[i]))
+        for i in range(len(rates))
+        if previous[i] > 0
+    ]
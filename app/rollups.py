@@ -0,0 +1,186 @@
+import logging
+import time
+
+from sqlalchemy import text
+
+from app import data_version, database
+
+logger = logging.getLogger(__name__)
+
+MEASURES = """
+    SUM(total_price) AS total_price,
+    SUM(offer_price) AS offer_price,
+    SUM(prix_annuel) AS prix_annuel,
+"""
+
+# Ordered from the coarsest to the finest grain, the router picks the first one
+# whose keys cover every fact column a query groups or filters on.
+ROLLUPS = [
+    {"table": "agg_requests_day", "keys": ["date_fk", "pick_up_day"]},
+    {"table": "agg_requests_day_bench", "keys": ["date_fk", "pick_up_day", "bench1_fk"]},
+    {"table": "agg_requests_day_req_type", "keys": ["date_fk", "pick_up_day", "req_type_fk"]},
+    {"table": "agg_requests_day_car", "keys": ["date_fk", "pick_up_day", "car_fk"]},
+    {
+        "table": "agg_requests_day_full",
+        "keys": ["date_fk", "pick_up_day", "car_fk", "req_type_fk", "bench1_fk", "region_fk", "offer_fk"],
+    },
+]
+
+FINEST = ROLLUPS[-1]
+
+FACT_SOURCE = {
+    "table": "factrequests",
+    "day": "f.pick_up_date",
+    "count": "COUNT(f.req_pk)",
+    # Rows where either price is NULL are skipped, as in the per-row difference.
+    "gain": "SUM(f.total_price - f.offer_price)",
+}
+
+STATE_TABLE = "rollup_state"
+
+available = set()
+# Data version of the fact table the rollups were built from. When the
+# warehouse has been loaded since, the rollups are stale and queries go to the
+# fact table until the next refresh.
+_built_for = {"version": None, "checked_at": 0.0}
+
+
+def _redetect():
+    # Rollups may have been rebuilt by another worker or by the command line,
+    # rollup_state is read again at most once per probe interval.
+    _built_for["checked_at"] = time.monotonic()
+    db = database.SessionLocal()
+    try:
+        detect(db)
+    except Exception as e:
+        logger.warning("rollup detection failed: %s", e)
+    finally:
+        db.close()
+
+
+def current():
+    try:
+        version = data_version.current()
+    except Exception:
+        return False
+    if _built_for["version"] != version and time.monotonic() - _built_for["checked_at"] >= data_version.PROBE_INTERVAL:
+        _redetect()
+    return bool(available) and _built_for["version"] == version
+
+
+def source_for(*keys):
+    needed = set(keys)
+    if not current():
+        return FACT_SOURCE
+    for rollup in ROLLUPS:
+        if rollup["table"] in available and needed <= set(rollup["keys"]):
+            return {
+                "table": rollup["table"],
+                "day": "f.pick_up_day",
+                "count": "SUM(f.request_count)",
+                "gain": "SUM(f.gain)",
+            }
+    return FACT_SOURCE
+
+
+def detect(db):
+    found = set()
+    if database.BACKEND != "postgres":
+        available.clear()
+        return []
+    for rollup in ROLLUPS:
+        # A rollup built before the gain measure existed is not used.
+        exists = db.execute(text("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = :name AND column_name = 'gain'
+        """), {"name": rollup["table"]}).scalar()
+        if exists:
+            found.add(rollup["table"])
+    built_for = None
+    if db.execute(text("SELECT to_regclass(:name)"), {"name": STATE_TABLE}).scalar():
+        built_for = db.execute(text(f"SELECT version FROM {STATE_TABLE}")).scalar()
+    available.clear()
+    available.update(found)
+    _built_for["version"] = built_for
+    _built_for["checked_at"] = time.monotonic()
+    return sorted(found)
+
+
+def _select_from_fact(keys):
+    columns = ", ".join("pick_up_date::date AS pick_up_day" if k == "pick_up_day" else k for k in keys)
+    group_by = ", ".join("pick_up_date::date" if k == "pick_up_day" else k for k in keys)
+    return f"""
+        SELECT {columns},{MEASURES}
+            SUM(total_price - offer_price) AS gain,
+            COUNT(req_pk) AS request_count
+        FROM factrequests
+        GROUP BY {group_by}
+    """
+
+
+def _select_from_rollup(source, keys):
+    columns = ", ".join(keys)
+    return f"""
+        SELECT {columns},{MEASURES}
+            SUM(gain) AS gain,
+            SUM(request_count) AS request_count
+        FROM {source}
+        GROUP BY {columns}
+    """
+
+
+def refresh(db, wait=True):
+    # The finest rollup is built from the fact table once, the coarser ones are
+    # re-aggregated from it so the fact table is scanned a single time.
+    # Workers refreshing at the same time would each scan it: without wait,
+    # a refresh already running elsewhere makes this one a no-op.
+    lock = "pg_advisory_xact_lock" if wait else "pg_try_advisory_xact_lock"
+    if db.execute(text(f"SELECT {lock}(hashtext(:name))"), {"name": STATE_TABLE}).scalar() is False:
+        db.rollback()
+        return detect(db)
+    db.execute(text("SET LOCAL statement_timeout = 0"))
+    # Probed before the scan: rows loaded meanwhile make the recorded version
+    # older than the data, which only sends queries to the fact table.
+    version = data_version.probe(db)
+    # Built under a new name and swapped in at the end: readers keep using
+    # the current tables during the scan, the renames only lock them briefly.
+    for rollup in reversed(ROLLUPS):
+        if rollup is FINEST:
+            select = _select_from_fact(rollup["keys"])
+        else:
+            select = _select_from_rollup(f"{FINEST['table']}_new", rollup["keys"])
+        db.execute(text(f"DROP TABLE IF EXISTS {rollup['table']}_new"))
+        db.execute(text(f"CREATE TABLE {rollup['table']}_new AS {select}"))
+        db.execute(text(f"ANALYZE {rollup['table']}_new"))
+    for rollup in ROLLUPS:
+        db.execute(text(f"DROP TABLE IF EXISTS {rollup['table']}"))
+        db.execute(text(f"ALTER TABLE {rollup['table']}_new RENAME TO {rollup['table']}"))
+    db.execute(text(f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} (version text NOT NULL, built_at timestamptz NOT NULL)"))
+    db.execute(text(f"DELETE FROM {STATE_TABLE}"))
+    db.execute(text(f"INSERT INTO {STATE_TABLE} VALUES (:version, now())"), {"version": version})
+    db.commit()
+    return detect(db)
+
+
+def refresh_if_stale(version):
+    # Called when the data version moves. Rollups are only rebuilt where they
+    # have been built before, and not when another worker already did it.
+    if database.BACKEND != "postgres":
+        return None
+    db = database.SessionLocal()
+    try:
+        detect(db)
+        if _built_for["version"] in (None, version):
+            return None
+        logger.info("rollups built for version %s, refreshing for %s", _built_for["version"], version)
+        return refresh(db, wait=False)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    db = database.SessionLocal()
+    try:
+        print("refreshed:", ", ".join(refresh(db)))
+    finally:
+        db.close()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import date
 
 
@@ -284,4 +284,37 @@ class TotalPricePrediction(BaseModel):
 class FleetOptimization(BaseModel):
     predicted_passenger_count: int
     recommended_fleet_size: int
-    adjusted_fleet_size: int
\ No newline at end of file
+    adjusted_fleet_size: int
+
+class TrainingWindow(BaseModel):
+    start: str
+    end: str
+
+class ModelInfo(BaseModel):
+    name: str
+    target: str
+    data_version: Optional[str]
+    features: Optional[str] = None
+    trained_at: str
+    training_window: TrainingWindow
+    row_count: int
+    request_count: Optional[int] = None
+    metrics: Dict[str, float]
+
+class ForecastPoint(BaseModel):
+    date: str
+    predicted_total_price: float
+    predicted_passenger_count: int
+    recommended_fleet_size: int
+    adjusted_fleet_size: int
+
+class ForecastBatchResponse(BaseModel):
+    data: List[ForecastPoint]
+
+class DashboardError(BaseModel):
+    status_code: int
+    detail: str
+
+class DashboardResponse(BaseModel):
+    data: Dict[str, Any]
+    errors: Dict[str, DashboardError]
@@ -0,0 +1,123 @@
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Optional
+
+from fastapi import HTTPException, Query, Request
+from fastapi.responses import Response
+
+from app import export
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, default=_default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class JSONBytesResponse(Response):
+    media_type = "application/json"
+
+    def __init__(self, content=None, status_code=200, headers=None, media_type=None, background=None):
+        # The payload is kept next to the encoded body so the dashboard can
+        # embed the cached result of an endpoint. The parameters are spelled
+        # out: FastAPI reads the status_code default to build the OpenAPI schema.
+        self.content = content
+        super().__init__(content, status_code=status_code, headers=headers, media_type=media_type, background=background)
+
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+    async def __call__(self, scope, receive, send):
+        # Cached and coalesced responses are sent to several clients at once,
+        # the middlewares that edit headers get their own copy of the list.
+        await send({"type": "http.response.start", "status": self.status_code, "headers": list(self.raw_headers)})
+        await send({"type": "http.response.body", "body": self.body})
+        if self.background is not None:
+            await self.background()
+
+
+def records(result):
+    # Rows are shaped in SQL (TRIM, ROUND, dates as text) and go to the
+    # encoder as plain dicts, without a pydantic model per row.
+    keys = list(result.keys())
+    return [dict(zip(keys, row)) for row in result]
+
+
+def data_response(rows):
+    return JSONBytesResponse({"data": rows})
+
+
+def payload(value):
+    return value.content if isinstance(value, JSONBytesResponse) else value
+
+
+COLUMNAR_MEDIA_TYPE = "application/vnd.spn.columnar+json"
+ARROW_MEDIA_TYPE = export.FORMATS["arrow"]["media_type"]
+
+# Documents the alternative bodies of the endpoints that negotiate a format.
+FORMAT_RESPONSES = {
+    200: {
+        "content": {
+            COLUMNAR_MEDIA_TYPE: {"schema": {"type": "object", "additionalProperties": {"type": "array"}}},
+            ARROW_MEDIA_TYPE: {"schema": {"type": "string", "format": "binary"}},
+        }
+    }
+}
+
+
+def response_format(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(json|columnar|arrow)$")
+):
+    # ?format= wins over the Accept header, plain JSON stays the default.
+    if format:
+        return format
+    accept = request.headers.get("accept", "")
+    if ARROW_MEDIA_TYPE in accept:
+        return "arrow"
+    if COLUMNAR_MEDIA_TYPE in accept:
+        return "columnar"
+    return "json"
+
+
+def columns_of(rows):
+    names = list(rows[0]) if rows else []
+    return {name: [row[name] for row in rows] for name in names}
+
+
+def _arrow_ipc(columns):
+    if not export.arrow_available():
+        raise HTTPException(status_code=501, detail="arrow responses require pyarrow")
+    import pyarrow as pa
+
+    table = pa.table(columns)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def formatted_response(rows, format="json"):
+    headers = {"Vary": "Accept"}
+    if format == "columnar":
+        return JSONBytesResponse(columns_of(rows), headers=headers, media_type=COLUMNAR_MEDIA_TYPE)
+    if format == "arrow":
+        return JSONBytesResponse(_arrow_ipc(columns_of(rows)), headers=headers, media_type=ARROW_MEDIA_TYPE)
+    return JSONBytesResponse({"data": rows}, headers=headers)
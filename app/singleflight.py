@@ -0,0 +1,104 @@
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+MAX_TRACKED_KEYS = 1024
+
+
+class Group:
+    # Concurrent calls with the same key share one execution: the first
+    # caller runs it, the others wait for its result or exception.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self._keys = OrderedDict()
+        self._endpoints = {}
+
+    def _record(self, key, leader):
+        stats = self._keys.get(key)
+        if stats is None:
+            stats = self._keys[key] = {"executions": 0, "coalesced": 0}
+            while len(self._keys) > MAX_TRACKED_KEYS:
+                self._keys.popitem(last=False)
+        self._keys.move_to_end(key)
+        endpoint = self._endpoints.setdefault(key[0], {"executions": 0, "coalesced": 0})
+        field = "executions" if leader else "coalesced"
+        stats[field] += 1
+        endpoint[field] += 1
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+            self._record(key, leader)
+        if not leader:
+            return call.result()
+        try:
+            value = func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def do_async(self, key, func):
+        with self._lock:
+            task = self._async_calls.get(key)
+            leader = task is None
+            if leader:
+                task = self._async_calls[key] = asyncio.ensure_future(func())
+                task.add_done_callback(functools.partial(self._finished, key))
+            self._record(key, leader)
+        # The work runs as a task every caller awaits through a shield, the
+        # leader included: a client that disconnects does not cancel the query
+        # the others are waiting for.
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        with self._lock:
+            if self._async_calls.get(key) is task:
+                del self._async_calls[key]
+        if not task.cancelled():
+            # Marks the exception as retrieved when every caller went away.
+            task.exception()
+
+    def stats(self, top=20):
+        with self._lock:
+            keys = sorted(self._keys.items(), key=lambda item: item[1]["coalesced"], reverse=True)[:top]
+            return {
+                "in_flight": len(self._calls) + len(self._async_calls),
+                "endpoints": {name: dict(stats) for name, stats in self._endpoints.items()},
+                "top_keys": [
+                    {"endpoint": key[0], "params": repr(key[1]), **stats}
+                    for key, stats in keys
+                ],
+            }
+
+
+group = Group()
+
+
+def coalesce(func):
+    # For endpoints without the KPI cache: identical concurrent requests
+    # still run their query once.
+    from app import cache
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(**kwargs):
+            return await group.do_async(cache.make_key(func.__name__, kwargs), lambda: func(**kwargs))
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        return group.do(cache.make_key(func.__name__, kwargs), lambda: func(**kwargs))
+    return wrapper
@@ -0,0 +1,161 @@
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD_MS = float(os.getenv("SPN_SLOW_QUERY_MS", "1000"))
+# Share of slow statements re-run under EXPLAIN ANALYZE, 0 disables it.
+EXPLAIN_SAMPLE_RATE = float(os.getenv("SPN_SLOW_QUERY_EXPLAIN_RATE", "0"))
+PLAN_FILE = os.getenv("SPN_SLOW_QUERY_PLAN_FILE", "logs/slow_query_plans.jsonl")
+PLAN_FILE_MAX_BYTES = int(os.getenv("SPN_SLOW_QUERY_PLAN_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+PLAN_FILE_BACKUPS = int(os.getenv("SPN_SLOW_QUERY_PLAN_FILE_BACKUPS", "5"))
+RECENT_SIZE = 200
+
+_ids = itertools.count(1)
+_recent = deque(maxlen=RECENT_SIZE)
+_pending = queue.Queue(maxsize=100)
+_stats = {"slow_statements": 0, "plans_captured": 0, "plans_dropped": 0, "plan_errors": 0}
+_worker = None
+_worker_lock = threading.Lock()
+_plan_logger = None
+
+
+def _plans():
+    global _plan_logger
+    if _plan_logger is None:
+        os.makedirs(os.path.dirname(PLAN_FILE) or ".", exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            PLAN_FILE, maxBytes=PLAN_FILE_MAX_BYTES, backupCount=PLAN_FILE_BACKUPS
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        plan_logger = logging.getLogger(__name__ + ".plans")
+        plan_logger.propagate = False
+        plan_logger.setLevel(logging.INFO)
+        plan_logger.addHandler(handler)
+        _plan_logger = plan_logger
+    return _plan_logger
+
+
+def _jsonable(parameters):
+    if isinstance(parameters, dict):
+        return {key: _jsonable(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_jsonable(value) for value in parameters]
+    if parameters is None or isinstance(parameters, (str, int, float, bool)):
+        return parameters
+    return str(parameters)
+
+
+def _explain_loop():
+    from app import database, migrations
+
+    while True:
+        entry, parameters, asyncpg_style = _pending.get()
+        try:
+            raw = database.engine.raw_connection()
+            try:
+                plan = migrations.explain(
+                    raw, entry["statement"], parameters, asyncpg_style,
+                    options="ANALYZE, BUFFERS, FORMAT JSON",
+                )
+            finally:
+                raw.close()
+            _plans().info(json.dumps(dict(entry, plan=plan), default=str))
+            entry["plan_captured"] = True
+            _stats["plans_captured"] += 1
+        except Exception as e:
+            entry["plan_error"] = str(e)
+            _stats["plan_errors"] += 1
+
+
+def _schedule_explain(entry, parameters, asyncpg_style):
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_explain_loop, name="slow-query-explain", daemon=True)
+            _worker.start()
+    try:
+        _pending.put_nowait((entry, parameters, asyncpg_style))
+    except queue.Full:
+        _stats["plans_dropped"] += 1
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._spn_slow_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_spn_slow_started", None)
+    if started is None:
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    if duration_ms < THRESHOLD_MS:
+        return
+
+    entry = {
+        "id": next(_ids),
+        "logged_at": time.time(),
+        "route": metrics.current_route(),
+        "duration_ms": round(duration_ms, 2),
+        "statement": statement,
+        "parameters": _jsonable(parameters),
+        "plan_captured": False,
+    }
+    _recent.append(entry)
+    _stats["slow_statements"] += 1
+    logger.warning(
+        "slow query %s on %s: %.1f ms %s %s",
+        entry["id"], entry["route"], duration_ms, " ".join(statement.split()), entry["parameters"],
+    )
+
+    # EXPLAIN ANALYZE runs the statement again, it is done by a background
+    # thread on its own connection so the request is not slowed down twice.
+    is_select = statement.lstrip().upper().startswith(("SELECT", "WITH"))
+    if (
+        is_select and not executemany and conn.dialect.name == "postgresql"
+        and EXPLAIN_SAMPLE_RATE > 0 and random.random() < EXPLAIN_SAMPLE_RATE
+    ):
+        _schedule_explain(entry, parameters, conn.dialect.driver == "asyncpg")
+
+
+def instrument(engine):
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+
+def recent(limit=50):
+    return list(reversed(list(_recent)[-limit:]))
+
+
+def plans(limit=20):
+    # Only the current file is read, rotated backups stay on disk.
+    if not os.path.exists(PLAN_FILE):
+        return []
+    with open(PLAN_FILE) as f:
+        lines = deque(f, maxlen=limit)
+    return [json.loads(line) for line in reversed(lines)]
+
+
+def info():
+    return dict(
+        _stats,
+        threshold_ms=THRESHOLD_MS,
+        explain_sample_rate=EXPLAIN_SAMPLE_RATE,
+        plan_file=PLAN_FILE,
+        pending_plans=_pending.qsize(),
+    )
@@ -0,0 +1,320 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+import numpy as np
+from sqlalchemy import text
+
+from app import cache, data_version, database, filters
+
+ENABLED = os.getenv("SPN_ENGINE", "sql") == "snapshot"
+REFRESH_INTERVAL = float(os.getenv("SPN_SNAPSHOT_REFRESH_SECONDS", "60"))
+BATCH_SIZE = 100000
+
+EPOCH = date(1970, 1, 1)
+
+FACT_QUERY = text("""
+    SELECT
+        req_pk,
+        date_fk,
+        car_fk,
+        req_type_fk,
+        bench1_fk,
+        region_fk,
+        offer_fk,
+        pick_up_date::date - DATE '1970-01-01' AS pick_up_day,
+        total_price,
+        offer_price,
+        prix_annuel,
+        total_price - offer_price AS gain
+    FROM factrequests
+    WHERE req_pk > :watermark
+    ORDER BY req_pk
+""")
+
+KEYS = ("date_fk", "car_fk", "req_type_fk", "bench1_fk", "region_fk", "offer_fk")
+# gain is the per-row difference: a row where either price is NULL adds
+# nothing, like SUM(total_price - offer_price).
+MEASURES = ("total_price", "offer_price", "prix_annuel", "gain")
+
+# dimension -> (query, encoded attributes)
+DIMENSIONS = {
+    "dimdates": ("SELECT date_pk, date - DATE '1970-01-01' AS day FROM dimdates", ()),
+    "dimcars": ("SELECT car_pk, brand, slug FROM dimcars", ("brand", "slug")),
+    "dimoffers": ("SELECT offer_pk, adjustement_type FROM dimoffers", ("adjustement_type",)),
+    "dimrequesttypes": ("SELECT req_type_pk, req_type FROM dimrequesttypes", ("req_type",)),
+    "dimbenchmarks": ("SELECT benchmark_pk, source FROM dimbenchmarks", ("source",)),
+}
+
+BrandGainRow = namedtuple("BrandGainRow", ["brand", "total_gain"])
+TimelineRow = namedtuple("TimelineRow", ["date", "request_count", "total_revenue"])
+OfferRow = namedtuple("OfferRow", ["adjustement_type", "request_count"])
+
+_refresh_lock = threading.Lock()
+_wake = threading.Event()
+_state = None
+_stats = {
+    "loads": 0,
+    "last_refresh_seconds": None,
+    "last_refresh_rows": 0,
+    "refreshed_at": None,
+    "last_error": None,
+    "queries": {},
+}
+
+
+def active():
+    # Results are cached and ETagged under the current data version: the
+    # snapshot is only used once it has loaded that version, queries go to
+    # the database until the woken refresh catches up.
+    state = _state
+    if not ENABLED or state is None:
+        return False
+    try:
+        version = data_version.current()
+    except Exception:
+        return True
+    if state["version"] != version:
+        _wake.set()
+        return False
+    return True
+
+
+def _empty_columns():
+    columns = {"req_pk": np.empty(0, dtype=np.int64), "pick_up_day": np.empty(0, dtype=np.int32)}
+    columns.update({key: np.empty(0, dtype=np.int32) for key in KEYS})
+    columns.update({measure: np.empty(0, dtype=np.float64) for measure in MEASURES})
+    return columns
+
+
+def _to_columns(rows, names):
+    values = list(zip(*rows))
+    columns = {}
+    for i, name in enumerate(names):
+        if name in MEASURES:
+            columns[name] = np.array([0.0 if v is None else float(v) for v in values[i]], dtype=np.float64)
+        elif name == "req_pk":
+            columns[name] = np.array(values[i], dtype=np.int64)
+        else:
+            # Missing keys become -1 and never match a dimension member.
+            columns[name] = np.array([-1 if v is None else v for v in values[i]], dtype=np.int32)
+    return columns
+
+
+def _load_dimension(conn, query, attributes):
+    rows = conn.execute(text(query)).fetchall()
+    pks = np.array([row[0] for row in rows], dtype=np.int64)
+    size = int(pks.max()) + 1 if pks.size else 0
+    dimension = {"pks": pks}
+    if not attributes:
+        lookup = np.full(size, -1, dtype=np.int32)
+        lookup[pks] = [row[1] for row in rows]
+        dimension["lookup"] = lookup
+        return dimension
+    for i, attribute in enumerate(attributes, start=1):
+        # Dictionary encoding: one array of distinct labels, one code per key.
+        labels = sorted(set((row[i] or "").strip() for row in rows))
+        code_of = {label: code for code, label in enumerate(labels)}
+        lookup = np.full(size, -1, dtype=np.int32)
+        lookup[pks] = [code_of[(row[i] or "").strip()] for row in rows]
+        dimension[attribute] = {"labels": labels, "lookup": lookup}
+    return dimension
+
+
+def refresh():
+    global _state
+    with _refresh_lock:
+        started = time.perf_counter()
+        previous = _state
+        watermark = int(previous["columns"]["req_pk"][-1]) if previous and previous["rows"] else 0
+        # Probed before the scan: rows loaded meanwhile make the snapshot
+        # newer than its version, never older.
+        version = data_version.current(force=True)
+
+        chunks = []
+        with database.engine.connect() as conn:
+            dimensions = {
+                name: _load_dimension(conn, query, attributes)
+                for name, (query, attributes) in DIMENSIONS.items()
+            }
+            result = conn.execution_options(stream_results=True).execute(FACT_QUERY, {"watermark": watermark})
+            names = list(result.keys())
+            for partition in result.partitions(BATCH_SIZE):
+                chunks.append(_to_columns(partition, names))
+
+        base = previous["columns"] if previous else _empty_columns()
+        columns = {
+            name: np.concatenate([base[name]] + [chunk[name] for chunk in chunks])
+            for name in base
+        }
+        added = sum(len(chunk["req_pk"]) for chunk in chunks)
+
+        _state = {"columns": columns, "dimensions": dimensions, "rows": len(columns["req_pk"]), "version": version}
+        _stats["loads"] += 1
+        _stats["last_refresh_seconds"] = round(time.perf_counter() - started, 4)
+        _stats["last_refresh_rows"] = added
+        _stats["refreshed_at"] = time.time()
+        return added
+
+
+def _refresh_loop():
+    while True:
+        _wake.wait(REFRESH_INTERVAL)
+        _wake.clear()
+        try:
+            if refresh():
+                cache.clear()
+            _stats["last_error"] = None
+        except Exception as e:
+            _stats["last_error"] = str(e)
+
+
+def start():
+    refresh()
+    threading.Thread(target=_refresh_loop, name="snapshot-refresh", daemon=True).start()
+
+
+def _codes(state, key, dimension, attribute=None):
+    fk = state["columns"][key]
+    lookup = state["dimensions"][dimension][attribute]["lookup"] if attribute else state["dimensions"][dimension]["lookup"]
+    codes = np.full(fk.shape, -1, dtype=np.int32)
+    valid = (fk >= 0) & (fk < lookup.size)
+    codes[valid] = lookup[fk[valid]]
+    return codes
+
+
+def _mask(state, params, day_column="pick_up_day", slug=False):
+    mask = np.ones(state["rows"], dtype=bool)
+    if filters.has_date_range(params):
+        bound = filters.bind(params)
+        if day_column == "pick_up_day":
+            day = state["columns"]["pick_up_day"]
+        else:
+            day = _codes(state, "date_fk", "dimdates")
+        start = (bound["start_date"] - EPOCH).days
+        end = (bound["end_date_exclusive"] - EPOCH).days
+        mask &= (day >= start) & (day < end)
+    if slug and params.get("slug"):
+        slugs = state["dimensions"]["dimcars"]["slug"]
+        labels = slugs["labels"]
+        wanted = labels.index(params["slug"].strip()) if params["slug"].strip() in labels else -2
+        mask &= _codes(state, "car_fk", "dimcars", "slug") == wanted
+    return mask
+
+
+def _group(codes, mask, weights, size):
+    keep = mask & (codes >= 0)
+    return np.bincount(codes[keep], weights=None if weights is None else weights[keep], minlength=size)
+
+
+def _timed(name, started):
+    elapsed = time.perf_counter() - started
+    entry = _stats["queries"].setdefault(name, {"count": 0, "total_seconds": 0.0, "last_seconds": 0.0})
+    entry["count"] += 1
+    entry["total_seconds"] += elapsed
+    entry["last_seconds"] = elapsed
+
+
+def total_charge(params):
+    started = time.perf_counter()
+    state = _state
+    mask = _mask(state, params)
+    total = float(state["columns"]["prix_annuel"][mask].sum()) if mask.any() else None
+    _timed("charge_kpi", started)
+    return total
+
+
+def total_price(params):
+    started = time.perf_counter()
+    state = _state
+    mask = _mask(state, params, day_column="date") & (_codes(state, "date_fk", "dimdates") >= 0)
+    total = float(state["columns"]["total_price"][mask].sum()) if mask.any() else None
+    _timed("total_price", started)
+    return total
+
+
+def brand_gains(params):
+    started = time.perf_counter()
+    state = _state
+    brand = state["dimensions"]["dimcars"]["brand"]
+    codes = _codes(state, "car_fk", "dimcars", "brand")
+    mask = _mask(state, params, slug=True)
+    size = len(brand["labels"])
+    gains = _group(codes, mask, state["columns"]["gain"], size)
+    present = np.flatnonzero(_group(codes, mask, None, size))
+    _timed("brand_gains", started)
+    return [BrandGainRow(brand["labels"][i], float(gains[i])) for i in present]
+
+
+def timeline(params):
+    started = time.perf_counter()
+    state = _state
+    days = _codes(state, "date_fk", "dimdates")
+    mask = _mask(state, params) & (days >= 0)
+    if not mask.any():
+        _timed("timeline_kpi", started)
+        return []
+    first = int(days[mask].min())
+    offsets = np.where(mask, days - first, -1)
+    size = int(offsets.max()) + 1
+    counts = _group(offsets, mask, None, size)
+    revenue = _group(offsets, mask, state["columns"]["total_price"], size)
+    present = np.flatnonzero(counts)
+    _timed("timeline_kpi", started)
+    return [
+        TimelineRow(EPOCH + timedelta(days=first + int(i)), int(counts[i]), float(revenue[i]))
+        for i in present
+    ]
+
+
+def requests_per_offer(params):
+    started = time.perf_counter()
+    state = _state
+    offers = state["dimensions"]["dimoffers"]["adjustement_type"]
+    codes = _codes(state, "offer_fk", "dimoffers", "adjustement_type")
+    counts = _group(codes, _mask(state, params), None, len(offers["labels"]))
+    present = np.flatnonzero(counts)
+    _timed("requests_per_offer", started)
+    return [OfferRow(offers["labels"][i], int(counts[i])) for i in present]
+
+
+def info():
+    state = _state
+    if state is None:
+        return {"enabled": ENABLED, "loaded": False}
+    columns = {
+        name: {"dtype": str(array.dtype), "nbytes": int(array.nbytes)}
+        for name, array in state["columns"].items()
+    }
+    dimension_bytes = sum(
+        int(value["lookup"].nbytes) if isinstance(value, dict) else int(value.nbytes)
+        for dimension in state["dimensions"].values()
+        for value in dimension.values()
+    )
+    queries = {
+        name: {
+            "count": entry["count"],
+            "avg_ms": round(entry["total_seconds"] / entry["count"] * 1000, 4),
+            "last_ms": round(entry["last_seconds"] * 1000, 4),
+        }
+        for name, entry in _stats["queries"].items()
+    }
+    return {
+        "enabled": ENABLED,
+        "loaded": True,
+        "version": state["version"],
+        "rows": state["rows"],
+        "watermark": int(state["columns"]["req_pk"][-1]) if state["rows"] else 0,
+        "columns": columns,
+        "fact_bytes": sum(column["nbytes"] for column in columns.values()),
+        "dimension_bytes": dimension_bytes,
+        "loads": _stats["loads"],
+        "last_refresh_seconds": _stats["last_refresh_seconds"],
+        "last_refresh_rows": _stats["last_refresh_rows"],
+        "refreshed_at": _stats["refreshed_at"],
+        "refresh_interval_seconds": REFRESH_INTERVAL,
+        "last_error": _stats["last_error"],
+        "queries": queries,
+    }
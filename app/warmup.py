@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import text
+
+from app import catalog, data_version, database, rollups
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("SPN_WARMUP", "1") == "1"
+# Forecasting workers load the models during warm-up, KPI-only workers never
+# import pandas and scikit-learn.
+PRELOAD_MODELS = os.getenv("SPN_PRELOAD_MODELS", "0") == "1"
+CONCURRENCY = int(os.getenv("SPN_WARMUP_CONCURRENCY", "4"))
+RETRY_SECONDS = float(os.getenv("SPN_WARMUP_RETRY_SECONDS", "5"))
+
+_state = {"ready": False, "started_at": None, "finished_at": None, "steps": {}}
+
+
+def _warm_sync_pool(size):
+    connections = []
+    try:
+        for _ in range(size):
+            conn = database.engine.connect()
+            connections.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+async def warm_pools():
+    # Opens pool_size connections on both engines so the first requests do
+    # not pay for the TCP and authentication round trips.
+    size = database.POOL_SETTINGS["pool_size"]
+    await asyncio.to_thread(_warm_sync_pool, size)
+    if database.AsyncSessionLocal is not None:
+        await asyncio.gather(*(database.fetch_scalar(text("SELECT 1")) for _ in range(size)))
+
+
+async def probe_data_version():
+    await asyncio.to_thread(data_version.current, True)
+
+
+def _detect_rollups():
+    db = database.SessionLocal()
+    try:
+        rollups.detect(db)
+    finally:
+        db.close()
+
+
+async def detect_rollups():
+    await asyncio.to_thread(_detect_rollups)
+
+
+async def load_catalog():
+    await asyncio.to_thread(catalog.ensure_current)
+
+
+async def load_models():
+    from app import forecasting
+
+    await asyncio.to_thread(forecasting.ensure_loaded)
+
+
+async def bounded(factories, concurrency=CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(factory):
+        async with semaphore:
+            return await factory()
+
+    return await asyncio.gather(*(run(factory) for factory in factories), return_exceptions=True)
+
+
+async def _run_step(name, step, required):
+    started = time.perf_counter()
+    while True:
+        try:
+            await step()
+            _state["steps"][name] = {"seconds": round(time.perf_counter() - started, 3), "error": None}
+            return
+        except Exception as e:
+            _state["steps"][name] = {"seconds": round(time.perf_counter() - started, 3), "error": str(e)}
+            if not required:
+                logger.warning("warm-up step %s failed: %s", name, e)
+                return
+            logger.warning("warm-up step %s failed, retrying in %ss: %s", name, RETRY_SECONDS, e)
+            await asyncio.sleep(RETRY_SECONDS)
+
+
+async def run(steps):
+    # steps: (name, coroutine function, required). Required steps are retried
+    # until they pass, the worker only reports ready afterwards.
+    _state["started_at"] = time.time()
+    if ENABLED:
+        for name, step, required in steps:
+            await _run_step(name, step, required)
+    _state["ready"] = True
+    _state["finished_at"] = time.time()
+    logger.info("warm-up finished in %.1fs", _state["finished_at"] - _state["started_at"])
+
+
+def default_steps():
+    steps = [
+        ("pools", warm_pools, True),
+        ("data_version", probe_data_version, True),
+        ("rollups", detect_rollups, True),
+        ("catalog", load_catalog, False),
+    ]
+    if PRELOAD_MODELS:
+        steps.append(("models", load_models, False))
+    return steps
+
+
+def ready():
+    return _state["ready"]
+
+
+def info():
+    return {
+        "ready": _state["ready"],
+        "enabled": ENABLED,
+        "started_at": _state["started_at"],
+        "finished_at": _state["finished_at"],
+        "steps": dict(_state["steps"]),
+    }
@@ -0,0 +1,76 @@
+import argparse
+import json
+import sys
+
+
+def _change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare(baseline, candidate, threshold=0.10, min_delta_ms=5.0):
+    # A route regresses when its p95 or p99 grows by more than the threshold
+    # and by more than min_delta_ms, so fast routes do not flag on noise.
+    report = []
+    for path in sorted(set(baseline["routes"]) | set(candidate["routes"])):
+        before = baseline["routes"].get(path)
+        after = candidate["routes"].get(path)
+        entry = {"route": path, "before": before, "after": after, "regressions": []}
+        if before and after:
+            for stat in ("p95_ms", "p99_ms"):
+                change = _change(before[stat], after[stat])
+                if change is not None and change > threshold and after[stat] - before[stat] > min_delta_ms:
+                    entry["regressions"].append(f"{stat} {before[stat]} -> {after[stat]} (+{change:.0%})")
+            if after["errors"] > before["errors"]:
+                entry["regressions"].append(f"errors {before['errors']} -> {after['errors']}")
+        report.append(entry)
+
+    throughput = _change(baseline["overall"]["throughput_rps"], candidate["overall"]["throughput_rps"])
+    overall = []
+    if throughput is not None and throughput < -threshold:
+        overall.append(
+            f"throughput {baseline['overall']['throughput_rps']} -> "
+            f"{candidate['overall']['throughput_rps']} rps ({throughput:.0%})"
+        )
+    return report, overall
+
+
+def print_comparison(report, overall):
+    print(f"{'route':60} {'p95 before':>11} {'p95 after':>10} {'change':>8}")
+    for entry in report:
+        before = entry["before"]["p95_ms"] if entry["before"] else None
+        after = entry["after"]["p95_ms"] if entry["after"] else None
+        change = _change(before, after)
+        marker = "  REGRESSION" if entry["regressions"] else ""
+        print(
+            f"{entry['route']:60} {str(before):>11} {str(after):>10} "
+            f"{format(change, '+.0%') if change is not None else '-':>8}{marker}"
+        )
+    flagged = [entry for entry in report if entry["regressions"]]
+    for entry in flagged:
+        print(f"{entry['route']}: {', '.join(entry['regressions'])}")
+    for line in overall:
+        print(f"overall: {line}")
+    print(f"{len(flagged)} route(s) regressed" + (", overall throughput dropped" if overall else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs and flag regressions")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown that counts, 0.10 = 10%%")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    report, overall = compare(baseline, candidate, args.threshold, args.min_delta_ms)
+    print_comparison(report, overall)
+    return 1 if overall or any(entry["regressions"] for entry in report) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
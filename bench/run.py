@@ -0,0 +1,235 @@
+import argparse
+import json
+import math
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+SKIPPED_ROUTES = ("/admin", "/docs", "/redoc", "/openapi.json", "/metrics", "/export")
+
+# (weight, name): filter mixes sent to the routes that accept them, close to
+# what the dashboard sends: mostly unfiltered or a date range, sometimes a car
+# or a destination.
+SCENARIOS = [
+    (40, "unfiltered"),
+    (25, "month"),
+    (15, "quarter"),
+    (10, "slug"),
+    (5, "dest_code"),
+    (5, "slug_and_month"),
+]
+
+
+def _get_json(base_url, path, timeout):
+    with urllib.request.urlopen(base_url + path, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def discover(base_url, timeout=30):
+    spec = _get_json(base_url, "/openapi.json", timeout)
+    routes = []
+    for path, item in sorted(spec["paths"].items()):
+        if "get" not in item or "{" in path or path.startswith(SKIPPED_ROUTES):
+            continue
+        parameters = {parameter["name"]: parameter for parameter in item["get"].get("parameters", [])}
+        routes.append({"path": path, "parameters": parameters})
+    return routes
+
+
+def filter_values(base_url, timeout=30):
+    dates = sorted(_get_json(base_url, "/filters/dates", timeout))
+    return {
+        "slugs": sorted(_get_json(base_url, "/filters/car-types", timeout)),
+        "dest_codes": sorted(set(_get_json(base_url, "/filters/dests", timeout))),
+        "first_date": date.fromisoformat(dates[0]),
+        "last_date": date.fromisoformat(dates[-1]),
+    }
+
+
+def _month(rng, values):
+    months = (values["last_date"].year - values["first_date"].year) * 12 + values["last_date"].month - values["first_date"].month
+    offset = rng.randint(0, max(months, 0))
+    year = values["first_date"].year + (values["first_date"].month - 1 + offset) // 12
+    month = (values["first_date"].month - 1 + offset) % 12 + 1
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+
+
+def scenario_params(name, rng, values):
+    if name == "month":
+        return _month(rng, values)
+    if name == "quarter":
+        params = _month(rng, values)
+        start = date.fromisoformat(params["start_date"])
+        start = date(start.year, (start.month - 1) // 3 * 3 + 1, 1)
+        end = date(start.year + (start.month + 2) // 12, (start.month + 2) % 12 + 1, 1) - timedelta(days=1)
+        return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+    if name == "slug" and values["slugs"]:
+        return {"slug": rng.choice(values["slugs"])}
+    if name == "dest_code" and values["dest_codes"]:
+        return {"dest_code": rng.choice(values["dest_codes"])}
+    if name == "slug_and_month" and values["slugs"]:
+        return dict(_month(rng, values), slug=rng.choice(values["slugs"]))
+    return {}
+
+
+def required_params(route, values):
+    # Routes with mandatory parameters get a value that makes them succeed.
+    future = values["last_date"] + timedelta(days=30)
+    if route["path"] == "/forecast/batch":
+        return {"start_date": future.isoformat(), "end_date": (future + timedelta(days=29)).isoformat()}
+    if "future_date" in route["parameters"]:
+        return {"future_date": future.isoformat()}
+    return {}
+
+
+def plan(routes, values, requests, seed):
+    # Every route gets the same share of requests, the filters are drawn from
+    # a seeded RNG so two runs send exactly the same sequence.
+    rng = random.Random(seed)
+    weights = [weight for weight, _ in SCENARIOS]
+    names = [name for _, name in SCENARIOS]
+    planned = []
+    for i in range(requests):
+        route = routes[i % len(routes)]
+        scenario = rng.choices(names, weights=weights)[0]
+        params = {
+            name: value for name, value in scenario_params(scenario, rng, values).items()
+            if name in route["parameters"]
+        }
+        params.update(required_params(route, values))
+        planned.append((route["path"], scenario, params))
+    return planned
+
+
+def _call(base_url, path, params, timeout):
+    url = base_url + path
+    if params:
+        url += "?" + urllib.parse.urlencode(params, doseq=True)
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0
+    return status, (time.perf_counter() - started) * 1000
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest rank, no interpolation between samples.
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return round(sorted_values[rank - 1], 2)
+
+
+def summarize(samples, duration):
+    latencies = sorted(latency for _, latency in samples)
+    return {
+        "count": len(samples),
+        # 404 means an empty result for a filter combination, not a failure.
+        "errors": sum(1 for status, _ in samples if status == 0 or status >= 500),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "max_ms": round(latencies[-1], 2) if latencies else None,
+        "throughput_rps": round(len(samples) / duration, 2) if duration else None,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(base_url, concurrency=8, requests=2000, seed=42, warmup=True, timeout=60, routes=None):
+    discovered = discover(base_url, timeout)
+    if routes:
+        discovered = [route for route in discovered if route["path"] in routes]
+    values = filter_values(base_url, timeout)
+    planned = plan(discovered, values, requests, seed)
+
+    if warmup:
+        for route in discovered:
+            _call(base_url, route["path"], required_params(route, values), timeout)
+
+    lock = threading.Lock()
+    samples = {}
+
+    def execute(entry):
+        path, scenario, params = entry
+        status, latency = _call(base_url, path, params, timeout)
+        with lock:
+            samples.setdefault(path, []).append((status, latency))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(execute, planned))
+    duration = time.perf_counter() - started
+
+    everything = [sample for route_samples in samples.values() for sample in route_samples]
+    return {
+        "meta": {
+            "base_url": base_url,
+            "concurrency": concurrency,
+            "requests": requests,
+            "seed": seed,
+            "git_commit": _git_commit(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration_seconds": round(duration, 3),
+        },
+        "overall": summarize(everything, duration),
+        "routes": {path: summarize(route_samples, duration) for path, route_samples in sorted(samples.items())},
+    }
+
+
+def print_report(result):
+    print(f"{'route':60} {'count':>6} {'err':>4} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>8}")
+    rows = list(result["routes"].items()) + [("overall", result["overall"])]
+    for path, stats in rows:
+        print(
+            f"{path:60} {stats['count']:>6} {stats['errors']:>4} {stats['p50_ms']:>9} "
+            f"{stats['p95_ms']:>9} {stats['p99_ms']:>9} {stats['throughput_rps']:>8}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive every GET route of the API at a fixed concurrency")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--route", action="append", help="only run this route, can be repeated")
+    parser.add_argument("--no-warmup", action="store_true")
+    parser.add_argument("--output", help="write the results as JSON, to compare runs later")
+    args = parser.parse_args(argv)
+
+    result = run(
+        args.base_url.rstrip("/"), args.concurrency, args.requests, args.seed,
+        warmup=not args.no_warmup, timeout=args.timeout, routes=args.route,
+    )
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()